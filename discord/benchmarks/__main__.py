@@ -0,0 +1,244 @@
+"""Offline micro-benchmarks for the cog hot paths.
+
+Every backend is replaced by a local stub server, so runs need no network
+and no credentials. Run from the ``discord`` directory::
+
+    python -m benchmarks                      # all benchmarks
+    python -m benchmarks -k tex --latency 20  # only tex, 20 ms stub latency
+    python -m benchmarks --compare benchmarks/results/<earlier run>.json
+
+Each run is written to ``benchmarks/results/`` as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List, Optional
+
+os.environ.setdefault('WOLFRAM_APPID', 'benchmark')
+
+from bots.cogs import Code, TeX, Translate, Wolfram  # noqa: E402
+from bots.core.bot import Bot  # noqa: E402
+from bots.core.llm import OpenAIClient  # noqa: E402
+
+from .stubs import FakeContext, FakeMessage, StubServer, fake_user  # noqa: E402
+
+RESULTS_DIR = pathlib.Path(__file__).parent / 'results'
+
+Call = Callable[[int], Awaitable[object]]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(call: Call, iterations: int, concurrency: int, alloc_iterations: int) -> Dict[str, float]:
+    """Time ``iterations`` calls, ``concurrency`` at a time, then trace allocations of a few more."""
+    for i in range(min(5, iterations)):
+        await call(-1 - i)
+    latencies = []
+    counter = iter(range(iterations))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            await call(iterations + i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'calls': iterations,
+        'throughput': iterations / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_alloc_kib': statistics.mean(peaks) / 1024 if peaks else 0.0,
+    }
+
+
+class Bench:
+    """Points the cogs at ``stub`` and builds the calls to benchmark."""
+
+    def __init__(self, stub: StubServer, tmp: pathlib.Path):
+        self.stub = stub
+        Code.URL = f'{stub.url}/wandbox/'
+        Code.catalogue.snapshot_path = tmp / 'wandbox-languages.json'
+        Code.catalogue.set_languages({})
+        Code.catalogue.updated_at = 0.0
+        TeX.URL = f'{stub.url}/tex/render/png'
+        TeX.render_cache.directory = tmp / 'tex-cache'
+        Wolfram.URL = f'{stub.url}/wolfram/v2/query'
+        Translate.translation_cache.path = tmp / 'translations.sqlite3'
+        self.bot = Bot('benchmark', [], ']', data_dir=tmp)
+        self.bot.openai_client = OpenAIClient(api_key='benchmark', base_url=f'{stub.url}/openai/v1')
+        # What the gateway would have filled in on login.
+        self.bot._connection.user = fake_user(0, bot=True)
+        self.wolfram = Wolfram.Wolfram(self.bot)
+        self.translate = Translate.Translate(self.bot)
+        self.author = fake_user()
+
+    async def close(self):
+        await self.bot.http_pool.close()
+        await self.bot.openai_client.close()
+        Translate.translation_cache.close()
+
+    def calls(self) -> Dict[str, Call]:
+        session = self.bot.http_session
+        author = self.author
+
+        async def send(embed):
+            return FakeMessage(id=0)
+
+        async def code_run_streaming(i):
+            return await Code.run_streaming(session, author, 'python', f'print({i})', send)
+
+        async def code_run_streaming_shared(i):
+            return await Code.run_streaming(session, author, 'python', 'print(0)', send)
+
+        async def code_run_streaming_unknown_language(i):
+            return await Code.run_streaming(session, author, 'no-such-language', 'x', send)
+
+        async def tex_respond_core_cold(i):
+            return await TeX.respond_core(session, author, f'x^{{{i}}} + {time.perf_counter_ns()}', False)
+
+        async def tex_respond_core_warm(i):
+            return await TeX.respond_core(session, author, r'\int_0^1 x\,dx', False)
+
+        async def wolfram_wolf(i):
+            ctx = FakeContext(author, message_id=i)
+            return await Wolfram.Wolfram.wolf.callback(self.wolfram, ctx, query=f'integrate x^{i}')
+
+        async def translate_translate(i):
+            ctx = FakeContext(author)
+            return await Translate.Translate.translate.callback(self.translate, ctx, f'hello {time.perf_counter_ns()}', 'ja')
+
+        async def translate_translate_cached(i):
+            ctx = FakeContext(author)
+            return await Translate.Translate.translate.callback(self.translate, ctx, 'hello', 'ja')
+
+        async def translate_translate_recent(i):
+            ctx = FakeContext(author)
+            ctx.channel.messages = [
+                FakeMessage(id=j, content=f'message {j} {time.perf_counter_ns()}', author=fake_user(j % 5 + 2))
+                for j in range(Translate.RECENT_LIMIT)
+            ]
+            return await Translate.Translate.translate_recent.callback(
+                self.translate, ctx, Translate.RECENT_LIMIT, 'ja'
+            )
+
+        async def bot_on_message(i):
+            message = FakeMessage(
+                id=i,
+                content=f'just chatting {i}',
+                author=fake_user(i % 50 + 2),
+                channel=None,
+                guild=None,
+                _state=self.bot._connection,
+            )
+            return await self.bot.on_message(message)
+
+        return {
+            'code.run_streaming': code_run_streaming,
+            'code.run_streaming.shared': code_run_streaming_shared,
+            'code.run_streaming.unknown_language': code_run_streaming_unknown_language,
+            'tex.respond_core.cold': tex_respond_core_cold,
+            'tex.respond_core.warm': tex_respond_core_warm,
+            'wolfram.wolf': wolfram_wolf,
+            'translate.translate': translate_translate,
+            'translate.translate.cached': translate_translate_cached,
+            'translate.translate_recent': translate_translate_recent,
+            'bot.on_message': bot_on_message,
+        }
+
+
+def compare(current: Dict[str, Dict[str, float]], previous: Dict[str, Dict[str, float]]):
+    print(f'\n{"benchmark":36} {"throughput":>12} {"p50":>10} {"p99":>10} {"alloc":>10}')
+    for name, result in current.items():
+        before = previous.get(name)
+        if before is None:
+            continue
+
+        def change(key: str) -> str:
+            if not before[key]:
+                return '-'
+            return f'{(result[key] - before[key]) / before[key] * 100:+.1f}%'
+
+        print(
+            f'{name:36} {change("throughput"):>12} {change("p50_ms"):>10} '
+            f'{change("p99_ms"):>10} {change("peak_alloc_kib"):>10}'
+        )
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    stub = StubServer(latency=args.latency / 1000)
+    await stub.start()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmp:
+        bench = Bench(stub, pathlib.Path(tmp))
+        try:
+            print(f'{"benchmark":36} {"calls/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"peak KiB/call":>14}')
+            for name, call in bench.calls().items():
+                if args.k and args.k not in name:
+                    continue
+                result = await measure(call, args.iterations, args.concurrency, args.alloc_iterations)
+                results[name] = result
+                print(
+                    f'{name:36} {result["throughput"]:>10.1f} {result["p50_ms"]:>8.2f} '
+                    f'{result["p99_ms"]:>8.2f} {result["peak_alloc_kib"]:>14.1f}'
+                )
+        finally:
+            await bench.close()
+            await stub.close()
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.splitlines()[0])
+    parser.add_argument('-k', help='only run benchmarks whose name contains this')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--alloc-iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='stub response latency in ms')
+    parser.add_argument('--compare', type=pathlib.Path, help='earlier results file to compare against')
+    parser.add_argument('--no-save', action='store_true')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.run(main(args))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / time.strftime('%Y%m%d-%H%M%S.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'platform': platform.platform(),
+                'args': {key: str(value) for key, value in vars(args).items()},
+                'results': results,
+            }, f, indent=2)
+        print(f'\nSaved to {path}')
@@ -0,0 +1,240 @@
+"""Local stand-ins for Wandbox, the tex service, Wolfram|Alpha and OpenAI."""
+import asyncio
+import json
+import re
+import struct
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Optional
+
+from aiohttp import web
+from discord.ext import commands
+
+SEGMENT_MARKER = re.compile(r'^(<<<\d+>>>)[ \t]*$', re.MULTILINE)
+
+WANDBOX_LANGUAGES = [
+    {'language': 'Python', 'name': 'cpython-3.12.0'},
+    {'language': 'C++', 'name': 'gcc-13.2.0'},
+    {'language': 'C', 'name': 'gcc-13.2.0-c'},
+    {'language': 'Rust', 'name': 'rust-1.73.0'},
+]
+
+
+def tiny_png() -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(b'\x00\x00'))
+        + chunk(b'IEND', b'')
+    )
+
+
+class StubServer:
+    """One aiohttp app serving every backend under its own path prefix.
+
+    ``latency`` seconds are added to each response to stand in for the network.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.png = tiny_png()
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def wandbox_list(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(WANDBOX_LANGUAGES)
+
+    async def wandbox_compile(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        await self._delay()
+        return web.json_response({
+            'status': '0',
+            'signal': '',
+            'compiler_output': '',
+            'compiler_error': '',
+            'compiler_message': '',
+            'program_output': params['code'][:200],
+            'program_error': '',
+            'program_message': params['code'][:200],
+        })
+
+    async def wandbox_compile_ndjson(self, request: web.Request) -> web.StreamResponse:
+        params = await request.json()
+        await self._delay()
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for kind, data in (('StdOut', params['code'][:200]), ('ExitCode', '0')):
+            await response.write(json.dumps({'type': kind, 'data': data}).encode() + b'\n')
+        await response.write_eof()
+        return response
+
+    async def tex_render(self, request: web.Request) -> web.Response:
+        params = await request.json()
+        await self._delay()
+        if '\\error' in params['latex']:
+            return web.Response(status=400, text='Undefined control sequence.')
+        return web.Response(body=self.png, content_type='image/png')
+
+    async def wolfram_query(self, request: web.Request) -> web.Response:
+        await self._delay()
+        first_pod = int(request.query.get('podindex', '1').split(',')[0])
+        pods = [
+            {
+                'title': f'Pod {i}',
+                'subpods': [{'plaintext': f'result {i}', 'img': {'src': f'https://example.invalid/{i}.gif'}}],
+            }
+            for i in range(first_pod, min(first_pod + 3, 7))
+        ]
+        return web.json_response({'queryresult': {'success': True, 'pods': pods}})
+
+    async def openai_chat(self, request: web.Request) -> web.StreamResponse:
+        params = await request.json()
+        await self._delay()
+        # "Translates" by reversing, segment by segment for batched requests.
+        parts = SEGMENT_MARKER.split(params['messages'][-1]['content'])
+        content = parts[0][::-1] + ''.join(
+            f'{marker}\n{text.strip()[::-1]}\n' for marker, text in zip(parts[1::2], parts[2::2])
+        )
+        if params.get('stream'):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for i in range(0, len(content), 4):
+                chunk = {
+                    'id': 'chatcmpl-stub',
+                    'object': 'chat.completion.chunk',
+                    'created': int(time.time()),
+                    'model': params['model'],
+                    'choices': [{'index': 0, 'delta': {'content': content[i:i + 4]}, 'finish_reason': None}],
+                }
+                await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        return web.json_response({
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': params['model'],
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/wandbox/list.json', self.wandbox_list)
+        app.router.add_post('/wandbox/compile.json', self.wandbox_compile)
+        app.router.add_post('/wandbox/compile.ndjson', self.wandbox_compile_ndjson)
+        app.router.add_post('/tex/render/png', self.tex_render)
+        app.router.add_get('/wolfram/v2/query', self.wolfram_query)
+        app.router.add_post('/openai/v1/chat/completions', self.openai_chat)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeMessage(SimpleNamespace):
+    async def delete(self):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+def fake_user(user_id: int = 1, bot: bool = False) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=user_id,
+        name=f'user{user_id}',
+        display_name=f'user{user_id}',
+        bot=bot,
+        guild=None,
+        display_avatar=SimpleNamespace(url=f'https://example.invalid/{user_id}.png'),
+    )
+
+
+class FakeHistory:
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def flatten(self):
+        return list(self.messages)
+
+
+class FakeChannel(SimpleNamespace):
+    messages = ()
+
+    def history(self, limit: int = 100):
+        # Newest first, like ``TextChannel.history``.
+        return FakeHistory(list(reversed(self.messages))[:limit])
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage(id=0)
+
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        return FakeMessage(id=0)
+
+
+class FakeContext(commands.Context):
+    """Enough of ``commands.Context`` and ``ApplicationContext`` for the benchmarked commands.
+
+    It subclasses ``commands.Context`` only to pass ``isinstance`` checks in
+    pycord's paginator; the properties it shadows are plain attributes here.
+    """
+
+    author = user = guild = channel = None
+
+    def __init__(self, author, message_id: int = 0):
+        self.author = self.user = author
+        self.guild = None
+        self.channel = FakeChannel(id=1)
+        self.message = FakeMessage(id=message_id, content='')
+        self.followup = FakeFollowup()
+
+    async def reply(self, *args, **kwargs):
+        return FakeMessage(id=0)
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage(id=0)
+
+    async def respond(self, *args, **kwargs):
+        return FakeMessage(id=0)
+
+    async def defer(self, *args, **kwargs):
+        pass
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from typing import Optional
 
 import discord
 
@@ -8,13 +9,33 @@ DEVELOPER_ID = 572432137035317249
 
 
 class DeleteButton(discord.ui.Button):
+    """Button deleting its message when pressed by ``user``.
+
+    The owner's id is encoded in the ``custom_id`` and presses are handled once,
+    by ``Bot.on_delete_button``, so the button keeps no state in memory and
+    keeps working after a restart. Send it with ``delete_view``.
+    """
+
+    PREFIX = 'delete:'
+
     def __init__(self, user: discord.User, label='Delete', style=discord.ButtonStyle.danger, *args, **kwargs):
         self.user_id = user.id
-        super().__init__(label=label, style=style, *args, **kwargs)
-
-    async def callback(self, interaction: discord.Interaction):
-        if self.user_id == interaction.user.id:
-            await interaction.message.delete()
+        super().__init__(label=label, style=style, custom_id=f'{self.PREFIX}{user.id}', *args, **kwargs)
+
+    @classmethod
+    def owner_id(cls, custom_id: str) -> Optional[int]:
+        """The owner encoded in ``custom_id``, or ``None`` if it is not a delete button's."""
+        if not custom_id.startswith(cls.PREFIX):
+            return None
+        try:
+            return int(custom_id[len(cls.PREFIX):])
+        except ValueError:
+            return None
+
+
+def delete_view(user: discord.User) -> discord.ui.View:
+    # store=False keeps the view out of the client's view store (py-cord 2.7+).
+    return discord.ui.View(DeleteButton(user), timeout=None, store=False)
 
 
 class LimitedSizeDict(OrderedDict):
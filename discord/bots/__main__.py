@@ -1,6 +1,7 @@
 import os
 
 from bots.core.bot import Bot
+from bots.core.cluster import ClusterLauncher
 from dotenv import load_dotenv
 
 load_dotenv(verbose=True)
@@ -18,7 +19,16 @@ GAATO_BOT_COGS = [
     "bots.cogs.Translate",
 ]
 
-if os.environ.get("GAATO_BOT"):
-    Bot(GAATO_BOT_TOKEN, GAATO_BOT_COGS, ")").run()
-else:
-    Bot(CODERUNBOT_TOKEN, CODERUNBOT_COGS, "]").run()
+# CLUSTERS > 1 spreads the shards over that many worker processes.
+CLUSTERS = int(os.environ.get("CLUSTERS", "1"))
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+
+if __name__ == "__main__":
+    if os.environ.get("GAATO_BOT"):
+        token, cogs, prefix = GAATO_BOT_TOKEN, GAATO_BOT_COGS, ")"
+    else:
+        token, cogs, prefix = CODERUNBOT_TOKEN, CODERUNBOT_COGS, "]"
+    if CLUSTERS > 1:
+        ClusterLauncher(token, cogs, prefix, CLUSTERS, shard_count=SHARD_COUNT).run()
+    else:
+        Bot(token, cogs, prefix, shard_count=SHARD_COUNT).run()
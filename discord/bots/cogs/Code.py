@@ -1,18 +1,46 @@
-import io
+import asyncio
+import json
+import os
 import pathlib
 import re
-from typing import List, Optional, Tuple
+import time
+import traceback
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import aiohttp
 import discord
-import requests
 from discord.ext import commands
 from discord.interactions import Interaction
 
-from .. import DeleteButton, LimitedSizeDict
+from .. import delete_view
+from ..core.autocomplete import PrefixIndex
+from ..core.coalesce import StreamCoalescer
+from ..core.execution import (
+    ExecutionBackend,
+    ExecutionRouter,
+    LocalBackend,
+    RemoteBackend,
+)
+from ..core.output import CappedText, attachment, describe_truncation, line_count
+from ..core.progressive import ProgressiveEdit
+from ..core.scheduler import Busy, get_scheduler, owner_of
 
 URL = "https://wandbox.org/api/"
 BASE_DIR = pathlib.Path(__file__).parent.parent
+# Stop reading a Wandbox response after this many bytes.
+RESPONSE_LIMIT = 8 * 1024 * 1024
+# Runs stream for as long as the program does, so only silence is a timeout.
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
 
 
 # dbname = BASE_DIR.parent / "db.sqlite3"
@@ -23,98 +51,245 @@ BASE_DIR = pathlib.Path(__file__).parent.parent
 # )
 
 
-def get_autocomplete_languages() -> List[str]:
-    with requests.get(URL + "list.json") as r:
-        r.raise_for_status()
-        result = r.json()
-        language_names = set(
-            map(lambda data: data["language"].lower().replace(" ", ""), result)
-        )
-        print(list(language_names))
-        return list(language_names)
-
-
-autocomplete_languages = get_autocomplete_languages()
+class LanguageCatalogue:
+    """Wandbox compilers keyed by normalized language name, served from memory.
+
+    The catalogue is seeded from an on-disk snapshot so a cold start needs no
+    network, and refreshed in the background once it is older than ``ttl``.
+    """
+
+    def __init__(self, snapshot_path: pathlib.Path, ttl: float = 6 * 60 * 60):
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self.languages: Dict[str, str] = {}
+        self.index = PrefixIndex([])
+        self.updated_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.load_snapshot()
+
+    @property
+    def stale(self) -> bool:
+        return time.time() - self.updated_at > self.ttl
+
+    @staticmethod
+    def build(result: List[dict]) -> Dict[str, str]:
+        languages = {}
+        for data in result:
+            languages.setdefault(
+                data["language"].lower().replace(" ", ""), data["name"]
+            )
+        return languages
+
+    def set_languages(self, languages: Dict[str, str]):
+        self.languages = languages
+        self.index = PrefixIndex((name, name) for name in languages)
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.set_languages(snapshot.get("languages", {}))
+        self.updated_at = snapshot.get("updated_at", 0.0)
+
+    def save_snapshot(self):
+        tmp_path = self.snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"updated_at": self.updated_at, "languages": self.languages}, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh(self, session: aiohttp.ClientSession):
+        async with session.get(URL + "list.json") as r:
+            if r.status != 200:
+                return
+            result = await r.json()
+        self.set_languages(self.build(result))
+        self.updated_at = time.time()
+        try:
+            self.save_snapshot()
+        except OSError:
+            traceback.print_exc()
+
+    def schedule_refresh(self, session: aiohttp.ClientSession):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        self._refresh_task = asyncio.create_task(self._refresh_quietly(session))
+
+    async def _refresh_quietly(self, session: aiohttp.ClientSession):
+        try:
+            await self.refresh(session)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            traceback.print_exc()
+
+    async def get(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        if not self.languages:
+            self.schedule_refresh(session)
+            await asyncio.shield(self._refresh_task)
+        elif self.stale:
+            self.schedule_refresh(session)
+        return self.languages
+
+
+catalogue = LanguageCatalogue(BASE_DIR / "data" / "wandbox-languages.json")
 
 
 def auto_complete_language(ctx: discord.AutocompleteContext) -> List[str]:
-    return list(
-        filter(
-            lambda language_code: language_code.startswith(ctx.value.lower()),
-            autocomplete_languages,
-        )
-    )
-
-
-async def get_languages() -> dict:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(URL + "list.json") as r:
-            if r.status == 200:
-                result = await r.json()
-                language_names = set(map(lambda data: data["language"], result))
-                languages_dict = {}
-                for language_name in language_names:
-                    language_information = next(
-                        filter(
-                            lambda language_information: language_information[
-                                "language"
-                            ]
-                            == language_name,
-                            result,
-                        )
-                    )
-                    languages_dict[language_name.lower().replace(" ", "")] = (
-                        language_information["name"]
-                    )
-    return languages_dict
-
-
-async def run_core(
+    if catalogue.stale:
+        catalogue.schedule_refresh(ctx.bot.http_session)
+    return catalogue.index.search(ctx.value)
+
+
+# Event types of Wandbox's compile.ndjson stream, mapped to compile.json result keys.
+NDJSON_KEYS = {
+    "CompilerMessageS": "compiler_output",
+    "CompilerMessageE": "compiler_error",
+    "StdOut": "program_output",
+    "StdErr": "program_error",
+    "ExitCode": "status",
+    "Signal": "signal",
+}
+
+
+class WandboxBackend(ExecutionBackend):
+    async def languages(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        return await catalogue.get(session)
+
+    @staticmethod
+    def params(language: str, compiler: str, code: str, stdin: str) -> Dict[str, str]:
+        if language == "nim":
+            compiler_option = (
+                "--hint[Processing]:off\n"
+                "--hint[Conf]:off\n"
+                "--hint[Link]:off\n"
+                "--hint[SuccessX]:off"
+            )
+        else:
+            compiler_option = ""
+        return {
+            "compiler": compiler,
+            "code": code,
+            "stdin": stdin,
+            "compiler-option-raw": compiler_option,
+        }
+
+    async def run(
+        self,
+        session: aiohttp.ClientSession,
+        language: str,
+        compiler: str,
+        code: str,
+        stdin: str,
+    ) -> Tuple[int, Optional[dict]]:
+        async for status, result in self.stream(
+            session, language, compiler, code, stdin
+        ):
+            pass
+        return status, result
+
+    async def stream(
+        self,
+        session: aiohttp.ClientSession,
+        language: str,
+        compiler: str,
+        code: str,
+        stdin: str,
+    ) -> AsyncIterator[Tuple[int, Optional[dict]]]:
+        params = self.params(language, compiler, code, stdin)
+        async with session.post(
+            URL + "compile.ndjson", json=params, timeout=STREAM_TIMEOUT
+        ) as r:
+            if r.status != 200:
+                yield r.status, None
+                return
+            outputs = {}
+            status = {}
+
+            def snapshot() -> dict:
+                result = {key: str(text) for key, text in outputs.items()}
+                result.update(status)
+                truncated = {
+                    key: (text.dropped_bytes, text.dropped_lines)
+                    for key, text in outputs.items()
+                    if text.dropped_bytes
+                }
+                if truncated:
+                    result["truncated"] = truncated
+                return result
+
+            received = 0
+            buffer = b""
+            async for chunk in r.content.iter_any():
+                received += len(chunk)
+                if received > RESPONSE_LIMIT:
+                    error = outputs.setdefault("program_error", CappedText())
+                    error.append(("\n" if error.kept else "") + "Output limit exceeded")
+                    break
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                changed = False
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    key = NDJSON_KEYS.get(event["type"])
+                    if key is None:
+                        continue
+                    if key in ("status", "signal"):
+                        status[key] = event["data"]
+                    else:
+                        outputs.setdefault(key, CappedText()).append(event["data"])
+                    changed = True
+                if changed:
+                    yield r.status, snapshot()
+            yield r.status, snapshot()
+
+
+# Comma-separated languages (e.g. "python,c,c++") to run instead of Wandbox: on the
+# runner at CODE_RUNNER_URL (python -m bots.runner), or else on this host.
+CODE_LOCAL_LANGUAGES = [
+    language.strip()
+    for language in os.environ.get("CODE_LOCAL_LANGUAGES", "").split(",")
+    if language.strip()
+]
+CODE_RUNNER_URL = os.environ.get("CODE_RUNNER_URL")
+local_backend: ExecutionBackend = (
+    RemoteBackend(CODE_RUNNER_URL)
+    if CODE_RUNNER_URL
+    else LocalBackend(enabled=CODE_LOCAL_LANGUAGES)
+)
+router = ExecutionRouter(
+    WandboxBackend(),
+    {language: local_backend for language in CODE_LOCAL_LANGUAGES},
+)
+backend_schedulers = {
+    router.fallback: get_scheduler("wandbox", concurrency=8, max_queued=64),
+    local_backend: get_scheduler("local", concurrency=2, max_queued=32),
+}
+executions = StreamCoalescer()
+
+
+def result_embed(
     author: discord.User,
     language: str,
-    code: str,
-    stdin: str = "",
-) -> Tuple[discord.Embed, Optional[discord.File]]:
-    language_dict = await get_languages()
-    if language not in language_dict.keys():
-        embed = discord.Embed(
-            title="The following languages are supported",
-            description=", ".join(language_dict.keys()),
-            color=0xFF0000,
-        )
-        embed.set_author(name=author.name, icon_url=author.display_avatar.url)
-        return embed, None
-    if language == "nim":
-        compiler_option = (
-            "--hint[Processing]:off\n"
-            "--hint[Conf]:off\n"
-            "--hint[Link]:off\n"
-            "--hint[SuccessX]:off"
-        )
+    compiler: str,
+    result: dict,
+    partial: bool = False,
+) -> Tuple[discord.Embed, List[discord.File]]:
+    """Build the reply for ``result``.
+
+    Long outputs are cut to their tail in the embed. Unless ``partial`` (progress
+    edits carry no files) they are also attached as ``.txt`` files, gzipped when
+    large: in full, or up to the cap for outputs listed under ``truncated``.
+    """
+    if partial:
+        embed = discord.Embed(title=f"Running ({compiler})...", color=0x808080)
     else:
-        compiler_option = ""
-    url = URL + "compile.json"
-    params = {
-        "compiler": language_dict[language],
-        "code": code,
-        "stdin": stdin,
-        "compiler-option-raw": compiler_option,
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=params) as r:
-            if r.status == 200:
-                result = await r.json()
-            else:
-                embed = discord.Embed(
-                    title="Connection Error", description=f"{r.status}", color=0xFF0000
-                )
-                embed.set_author(name=author.name, icon_url=author.display_avatar.url)
-                return embed, None
-    embed = discord.Embed(title=f"Result ({language_dict[language]}):")
+        embed = discord.Embed(title=f"Result ({compiler}):")
     embed_color = 0xFF0000
     files = []
+    truncated = result.get("truncated") or {}
     for k, v in result.items():
-        if k in ("program_message", "compiler_message"):
+        if k in ("program_message", "compiler_message", "truncated"):
             continue
         if v == "":
             continue
@@ -124,18 +299,135 @@ async def run_core(
             v = re.sub(r"CC: \S+\n", "", v)
             if v == "":
                 continue
-        if len(v) > 1000 or len(v.split("\n")) > 100:
-            files.append(discord.File(io.StringIO(v), k + ".txt"))
-        else:
+        name = k
+        if len(v) > 1000 or line_count(v) > 100:
+            if not partial:
+                files.append(discord.File(*attachment(v, k)))
+                if k in truncated:
+                    name = f"{k} (last lines before the cap, output up to the cap attached)"
+                else:
+                    name = f"{k} (last lines, full output attached)"
+            v = "\n".join(v[-1000:].split("\n")[-100:])
+        embed.add_field(
+            name=name,
+            value="```\n" + v + "\n```",
+        )
+    if not partial:
+        embed.color = embed_color
+        if truncated:
             embed.add_field(
-                name=k,
-                value="```\n" + v + "\n```",
+                name="truncated",
+                value="```\n" + describe_truncation(truncated) + "\n```",
+                inline=False,
             )
-    embed.color = embed_color
     embed.set_author(name=author.name, icon_url=author.display_avatar.url)
     return embed, files
 
 
+def unsupported_embed(
+    author: discord.User, language_dict: Dict[str, str]
+) -> discord.Embed:
+    embed = discord.Embed(
+        title="The following languages are supported",
+        description=", ".join(language_dict.keys()),
+        color=0xFF0000,
+    )
+    embed.set_author(name=author.name, icon_url=author.display_avatar.url)
+    return embed
+
+
+def busy_embed(author: discord.User) -> discord.Embed:
+    embed = discord.Embed(
+        title="Busy",
+        description="Too many programs are waiting to run. Please try again later.",
+        color=0xFF0000,
+    )
+    embed.set_author(name=author.name, icon_url=author.display_avatar.url)
+    return embed
+
+
+def connection_error_embed(
+    author: discord.User, status: Union[int, str]
+) -> discord.Embed:
+    embed = discord.Embed(
+        title="Connection Error", description=f"{status}", color=0xFF0000
+    )
+    embed.set_author(name=author.name, icon_url=author.display_avatar.url)
+    return embed
+
+
+async def run_streaming(
+    session: aiohttp.ClientSession,
+    author: discord.User,
+    language: str,
+    code: str,
+    send: Callable[[discord.Embed], Awaitable[discord.Message]],
+    stdin: str = "",
+    fields: Sequence[Tuple[str, str]] = (),
+) -> discord.Message:
+    """Run ``code``, replying via ``send`` at once and editing output in as it arrives.
+
+    Identical runs in flight at the same time share one execution.
+    ``fields`` are appended to every version of the embed.
+    """
+
+    def decorate(embed: discord.Embed) -> discord.Embed:
+        for name, value in fields:
+            embed.add_field(name=name, value=value)
+        return embed
+
+    def progress(result: dict) -> discord.Embed:
+        embed, _ = result_embed(author, language, compiler, result, partial=True)
+        return decorate(embed)
+
+    language_dict = await router.languages(session)
+    if language not in language_dict.keys():
+        return await send(decorate(unsupported_embed(author, language_dict)))
+    compiler = language_dict[language]
+    backend = router.backend_for(language)
+    scheduler = backend_schedulers[backend]
+
+    async def execute() -> AsyncIterator[Tuple[int, Optional[dict]]]:
+        async with scheduler.slot(owner_of(author)):
+            async for item in backend.stream(session, language, compiler, code, stdin):
+                yield item
+
+    reply = ProgressiveEdit(await send(progress({})))
+    status, result = 0, None
+    try:
+        async for status, result in executions.stream(
+            (compiler, code, stdin), execute
+        ):
+            if result is not None:
+                reply.update(embed=progress(result))
+    except Busy:
+        await reply.finish(embed=decorate(busy_embed(author)), attachments=[])
+        return reply.message
+    except asyncio.TimeoutError:
+        await reply.finish(
+            embed=decorate(connection_error_embed(author, "Timed out")),
+            attachments=[],
+        )
+        return reply.message
+    except aiohttp.ClientError as e:
+        await reply.finish(
+            embed=decorate(connection_error_embed(author, type(e).__name__)),
+            attachments=[],
+        )
+        return reply.message
+    except BaseException:
+        reply.cancel()
+        raise
+    if result is None:
+        await reply.finish(
+            embed=decorate(connection_error_embed(author, status)), attachments=[]
+        )
+    else:
+        embed, files = result_embed(author, language, compiler, result)
+        await reply.finish(embed=decorate(embed), files=files, attachments=[])
+    return reply.message
+
+
 # class EditButton(discord.ui.Button):
 #     def __init__(self, label="Edit", style=discord.ButtonStyle.primary, **kwargs):
 #         super().__init__(label=label, style=style, **kwargs)
@@ -223,19 +515,17 @@ class RunModal(discord.ui.Modal):
 
     async def callback(self, interaction: Interaction):
         await interaction.response.defer(invisible=False)
-        embed, files = await run_core(
+        view = delete_view(interaction.user)
+        m = await run_streaming(
+            interaction.client.http_session,
             interaction.user,
             self.language,
             self.children[0].value,
-            self.children[1].value,
-        )
-        embed.add_field(
-            name="Code",
-            value=f"```{self.language}\n{self.children[0].value}\n```",
-        )
-        view = discord.ui.View(DeleteButton(interaction.user), timeout=None)
-        m = await interaction.followup.send(
-            embed=embed, files=files, view=view, wait=True
+            lambda embed: interaction.followup.send(embed=embed, view=view, wait=True),
+            stdin=self.children[1].value,
+            fields=[
+                ("Code", f"```{self.language}\n{self.children[0].value}\n```"),
+            ],
         )
         # c.execute(
         #     "INSERT INTO code VALUES (?, ?, ?, ?, ?)",
@@ -252,22 +542,26 @@ class RunModal(discord.ui.Modal):
 class Code(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.user_message_id_to_bot_message = LimitedSizeDict(size_limit=100)
 
-    @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if before.content != after.content:
-            if before.id in self.user_message_id_to_bot_message:
-                await self.user_message_id_to_bot_message[before.id].delete()
+    async def startup(self):
+        if catalogue.stale:
+            catalogue.schedule_refresh(self.bot.http_session)
 
     @commands.command()
     async def run(self, ctx: commands.Context, language: str, *, code: str):
         """Run code"""
         code = re.sub(r"^```.*$", "", code, flags=re.MULTILINE)
-        view = discord.ui.View(DeleteButton(ctx.author), timeout=None)
-        embed, files = await run_core(ctx.author, language, code)
-        m = await ctx.reply(embed=embed, files=files, view=view)
-        self.user_message_id_to_bot_message[ctx.message.id] = m
+        key = (language, code.strip())
+        if self.bot.unchanged_edit(ctx, key):
+            return
+        view = delete_view(ctx.author)
+        await run_streaming(
+            self.bot.http_session,
+            ctx.author,
+            language,
+            code,
+            lambda embed: self.bot.replies.send(ctx, key, embed=embed, view=view),
+        )
 
     @discord.message_command()
     async def escape(self, ctx: discord.ApplicationContext, message: discord.Message):
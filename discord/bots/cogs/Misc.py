@@ -1,14 +1,15 @@
-import os
 import pathlib
-from collections import defaultdict
-from datetime import datetime, timedelta
 
 from discord.ext import commands
-from openai import AsyncOpenAI
 
 import discord
 
 from .. import DeleteButton
+from ..core.history import ChannelHistory
+from ..core.llm import stream_chat
+from ..core.progressive import MESSAGE_LIMIT, ProgressiveMessages, split_text
+from ..core.ratelimit import RateLimited
+from ..core.scheduler import Busy, get_scheduler, owner_of
 
 # from sudachipy import tokenizer, dictionary
 
@@ -16,78 +17,102 @@ from .. import DeleteButton
 
 BASE_DIR = pathlib.Path(__file__).parent.parent
 
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+scheduler = get_scheduler("openai", concurrency=4, max_queued=16)
+# Chat history sent with a mention, in approximate tokens.
+CONTEXT_TOKEN_BUDGET = 1500
+# Messages loaded over REST when a channel's history is not buffered yet.
+HISTORY_FETCH_LIMIT = 20
 
 
 class Misc(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.mention_times = defaultdict(list)
+        self.history = ChannelHistory()
         # self.tokenizer_obj = dictionary.Dictionary().create()
 
-    async def fetch_message_history(self, channel: discord.TextChannel, limit: int = 10):
-        history = await channel.history(limit=limit).flatten()
-        messages = []
-        for message in history:
-            messages.append({
-                "role": "user" if message.author != self.bot.user else "assistant",
-                "content": f"{message.content}"
-            })
-        messages.reverse()
-        return messages
-
-    def is_mention_limit_exceeded(self, user_id: int, time_limit: int = 60, max_mentions: int = 3):
-        now = datetime.now()
-        mention_times = self.mention_times[user_id]
-        # Remove mentions older than time_limit seconds
-        self.mention_times[user_id] = [time for time in mention_times if now - time < timedelta(seconds=time_limit)]
-        # Check if mention limit is exceeded
-        print(self.mention_times)
-        return len(self.mention_times[user_id]) >= max_mentions
+    async def message_history(self, channel: discord.abc.Messageable):
+        buffer = self.history.get(channel.id)
+        if buffer is None or not buffer.seeded:
+            # Cold channel: load it once; gateway events keep it current from then on.
+            fetched = await channel.history(limit=HISTORY_FETCH_LIMIT).flatten()
+            fetched.reverse()
+            self.history.seed(channel.id, [
+                message for message in fetched if message.author.id not in self.bot.opt_out_users
+            ])
+        return [
+            {
+                "role": "assistant" if entry.author_id == self.bot.user.id else "user",
+                "content": entry.content,
+            }
+            for entry in self.history.context(channel.id, CONTEXT_TOKEN_BUDGET)
+        ]
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if "content" in payload.data:
+            self.history.edit(payload.channel_id, payload.message_id, payload.data["content"])
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.history.delete(payload.channel_id, [payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.history.delete(payload.channel_id, payload.message_ids)
 
     @commands.Cog.listener("on_message")
     async def on_mentioned(self, message: discord.Message):
+        if message.author.id not in self.bot.opt_out_users:
+            self.history.add(message)
         if message.author.bot:
             return
         if str(self.bot.user.id) in message.content:
-            if self.is_mention_limit_exceeded(message.author.id):
+            try:
+                self.bot.rate_limiter.hit(
+                    "mention", message.author.id, message.guild.id if message.guild else None
+                )
+            except RateLimited:
                 return
-            self.mention_times[message.author.id].append(datetime.now())
             async with message.channel.typing():
-                history = await self.fetch_message_history(message.channel, limit=10)
-                history.append({
-                    "role": "assistant" if message.author.id == self.bot.user.id else "user",
-                    "content": message.content,
-                })
+                history = await self.message_history(message.channel)
                 if message.author.id == 572432137035317249:  # gaato.
-                    response = await client.chat.completions.create(
-                        model=   "gpt-4-turbo",
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": f"これはDiscordでのチャットです。"
-                                "以下の様々なユーザーによる直近のメッセージ履歴を参考に、"
-                                "あなたがメンションされている最後のメッセージに返信してください。"
-                            },
-                            *history
-                        ],
+                    model = "gpt-4-turbo"
+                    system = (
+                        "これはDiscordでのチャットです。"
+                        "以下の様々なユーザーによる直近のメッセージ履歴を参考に、"
+                        "あなたがメンションされている最後のメッセージに返信してください。"
                     )
                 else:
-                    response = await client.chat.completions.create(
-                        model=   "gpt-3.5-turbo",
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": f"これはDiscordのチャットです。"
-                                "以下は直近のメッセージ履歴です。"
-                                "一言で返信してください。"
-                            },
-                            *history
-                        ],
+                    model = "gpt-3.5-turbo"
+                    system = (
+                        "これはDiscordのチャットです。"
+                        "以下は直近のメッセージ履歴です。"
+                        "一言で返信してください。"
                     )
                 allowed_mentions = discord.AllowedMentions.none()
                 allowed_mentions.replied_user = True
-                await message.reply(response.choices[0].message.content, allowed_mentions=allowed_mentions)
+                # The first tokens are posted at once; the rest are edited in, spilling into more messages.
+                replies = ProgressiveMessages(
+                    lambda content: message.reply(content, allowed_mentions=allowed_mentions)
+                )
+                text = ""
+                try:
+                    async with scheduler.slot(owner_of(message.author)):
+                        async for text in stream_chat(
+                            self.bot.openai,
+                            model=model,
+                            messages=[{"role": "system", "content": system}, *history],
+                        ):
+                            if text.strip():
+                                await replies.update(
+                                    [{"content": piece} for piece in split_text(text, MESSAGE_LIMIT)]
+                                )
+                except Busy:
+                    return
+                if text.strip():
+                    await replies.finish(
+                        [{"content": piece} for piece in split_text(text, MESSAGE_LIMIT)]
+                    )
                 await self.bot.process_commands(message)
 
     # @discord.slash_command(
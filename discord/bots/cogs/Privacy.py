@@ -1,4 +1,3 @@
-import os
 import pathlib
 
 import discord
@@ -23,35 +22,15 @@ class Privacy(commands.Cog):
     @slash_command(name='opt-out')
     async def opt_out(self, ctx: discord.ApplicationContext):
         """Opt out of your message content data to be tracked"""
-        opt_out_users = []
-        if os.path.exists(BASE_DIR / 'data' / 'opt-out-users.txt'):
-            with open(BASE_DIR / 'data' / 'opt-out-users.txt', 'r') as f:
-                for line in f.readlines():
-                    if line.strip():
-                        opt_out_users.append(int(line))
-        if ctx.author.id in opt_out_users:
-            await ctx.respond('Your message content is already off-track. To use other commands, please use the /opt-in command.')
-        else:
-            opt_out_users.append(ctx.author.id)
-            with open(BASE_DIR / 'data' / 'opt-out-users.txt', 'w') as f:
-                for user in opt_out_users:
-                    f.write(str(user) + '\n')
+        if self.bot.opt_out_users.add(ctx.author.id):
             await ctx.respond('This bot will not track your message content from now on. Most commands will no longer respond.')
+        else:
+            await ctx.respond('Your message content is already off-track. To use other commands, please use the /opt-in command.')
 
     @slash_command(name='opt-in')
     async def opt_in(self, ctx: discord.ApplicationContext):
         """Opt out of your message content data to be tracked"""
-        opt_out_users = []
-        if os.path.exists(BASE_DIR / 'data' / 'opt-out-users.txt'):
-            with open(BASE_DIR / 'data' / 'opt-out-users.txt', 'r') as f:
-                for line in f.readlines():
-                    if line.strip():
-                        opt_out_users.append(int(line))
-        if ctx.author.id in opt_out_users:
-            opt_out_users.remove(ctx.author.id)
-            with open(BASE_DIR / 'data' / 'opt-out-users.txt', 'w') as f:
-                for user in opt_out_users:
-                    f.write(str(user) + '\n')
+        if self.bot.opt_out_users.remove(ctx.author.id):
             await ctx.respond('This bot will now track the content of your messages. It will only be used to provide commands. Use the /privacy-policy command to view the privacy policy.')
         else:
             await ctx.respond('This bot is already tracking your message content.')
@@ -1,48 +1,408 @@
+import asyncio
+import hashlib
 import io
+import os
 import pathlib
-from typing import Optional, Tuple
+import re
+import threading
+import traceback
+from collections import Counter
+from typing import List, Optional, Tuple
 
 import aiohttp
 import discord
 from discord.ext import commands
+from PIL import Image
 
-from .. import DeleteButton, LimitedSizeDict
+from .. import delete_view
+from ..core.cache import LRUCache
+from ..core.coalesce import Coalescer
+from ..core.mathtext import LocalRenderer
+from ..core.metrics import label_set, registry
+from ..core.scheduler import Busy, Owner, get_scheduler, owner_of
 
+URL = "http://tex/render/png"
 BASE_DIR = pathlib.Path(__file__).parent.parent
+# Opening and closing math delimiters, longest first.
+MATH_DELIMITERS = [("$$", "$$"), ("\\[", "\\]"), ("\\(", "\\)"), ("$", "$")]
+MAX_SEGMENTS = 10
+SEGMENT_SPACING = 16
+# Give up on the tex service after TEX_TIMEOUT seconds; race the local
+# renderer against it once it has taken TEX_HEDGE_DELAY seconds.
+SERVICE_TIMEOUT = float(os.environ.get("TEX_TIMEOUT", "20"))
+HEDGE_DELAY = float(os.environ.get("TEX_HEDGE_DELAY", "2"))
+RENDERER_SERVICE = "tex service"
+RENDERER_LOCAL = "local renderer"
 
 
-async def respond_core(
-    author: discord.User, code: str, spoiler: bool
-) -> Tuple[str, discord.Embed, Optional[discord.File]]:
-    url = "http://tex/render/png"
+class RenderCache:
+    """Rendered images keyed by a hash of the normalized LaTeX source.
+
+    PNGs live in a byte-bounded in-memory LRU backed by files in ``directory``.
+    The files are kept under ``max_disk_bytes``: once a write goes over, the
+    least recently used ones (by mtime, which disk hits refresh) are removed
+    until a tenth of the budget is free. Rendering errors are only kept in
+    memory, for ``error_ttl`` seconds.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        max_memory_bytes: int = 32 * 1024 * 1024,
+        max_disk_bytes: int = 128 * 1024 * 1024,
+        error_ttl: float = 60,
+    ):
+        self.directory = directory
+        self.images = LRUCache(max_memory_bytes)
+        self.errors = LRUCache(1024 * 1024)
+        self.max_disk_bytes = max_disk_bytes
+        self.error_ttl = error_ttl
+        self.stats = Counter()
+        self.disk_evictions = 0
+        # Bytes on disk, measured on the first write; other processes sharing
+        # the directory make it an estimate, so pruning measures again.
+        self._disk_bytes: Optional[int] = None
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def key(code: str) -> str:
+        normalized = "\n".join(
+            re.sub(r"[ \t]+", " ", line).strip() for line in code.strip().splitlines()
+        )
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.png"
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            image = self._path(key).read_bytes()
+            os.utime(self._path(key))
+            return image
+        except FileNotFoundError:
+            return None
+
+    def _files(self) -> List[Tuple[float, int, pathlib.Path]]:
+        files = []
+        for path in self.directory.glob("*.png"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _write(self, key: str, image: bytes):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path(key).with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(image)
+        os.replace(tmp_path, self._path(key))
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._files())
+            else:
+                self._disk_bytes += len(image)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune()
+
+    def _prune(self):
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 9 // 10
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.disk_evictions += 1
+        self._disk_bytes = total
+
+    async def get(self, key: str) -> Optional[Tuple[Optional[bytes], Optional[str]]]:
+        image = self.images.get(key)
+        if image is not None:
+            self.stats["memory_hits"] += 1
+            return image, None
+        error = self.errors.get(key)
+        if error is not None:
+            self.stats["error_hits"] += 1
+            return None, error
+        image = await asyncio.to_thread(self._read, key)
+        if image is not None:
+            self.stats["disk_hits"] += 1
+            self.images.set(key, image)
+            return image, None
+        self.stats["misses"] += 1
+        return None
+
+    async def set_image(self, key: str, image: bytes):
+        self.images.set(key, image)
+        try:
+            await asyncio.to_thread(self._write, key, image)
+        except OSError:
+            traceback.print_exc()
+
+    def set_error(self, key: str, error: str):
+        self.errors.set(key, error, ttl=self.error_ttl)
+
+
+render_cache = RenderCache(BASE_DIR / "data" / "tex-cache")
+registry.counter(
+    "tex_render_cache_lookups_total",
+    "Rendered image cache lookups, by result.",
+    lambda: {label_set(result=k): v for k, v in render_cache.stats.items()},
+)
+registry.gauge(
+    "tex_render_cache_hit_ratio",
+    "Share of rendered image cache lookups served without rendering.",
+    lambda: (
+        1 - render_cache.stats["misses"] / sum(render_cache.stats.values())
+        if render_cache.stats
+        else None
+    ),
+)
+registry.counter(
+    "tex_render_cache_disk_evictions_total",
+    "Rendered images removed from disk to stay under the disk budget.",
+    lambda: render_cache.disk_evictions,
+)
+renders_total = registry.counter(
+    "tex_renders_total", "Formulas rendered without the cache, by renderer and outcome."
+)
+renders = Coalescer()
+scheduler = get_scheduler("tex", concurrency=4, max_queued=64)
+local_renderer = LocalRenderer()
+
+
+async def render(
+    session: aiohttp.ClientSession, owner: Owner, code: str
+) -> Tuple[Optional[bytes], Optional[str], str]:
+    """Render ``code``; returns the image or an error, and the renderer that answered."""
+    key = render_cache.key(code)
+    cached = await render_cache.get(key)
+    if cached is not None:
+        return (*cached, RENDERER_SERVICE)
+    return await renders.run(
+        key,
+        lambda: scheduler.run(owner, lambda: render_hedged(session, key, code)),
+    )
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+async def render_hedged(
+    session: aiohttp.ClientSession, key: str, code: str
+) -> Tuple[Optional[bytes], Optional[str], str]:
+    """Ask the tex service, and the local renderer too if the service is slow or failing.
+
+    The first image wins and the other attempt is cancelled. Only images from
+    the service are cached, so a formula rendered locally during an incident is
+    rendered properly the next time.
+    """
+    service = asyncio.create_task(render_uncached(session, key, code))
+    attempts = {service: RENDERER_SERVICE}
+    done, _ = await asyncio.wait(attempts, timeout=HEDGE_DELAY)
+    if (not done or service.exception()) and local_renderer.available:
+        attempts[asyncio.create_task(local_renderer.render(code))] = RENDERER_LOCAL
+    pending = set(attempts)
+    errors = {}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                renderer = attempts[task]
+                if task.exception() is not None:
+                    result, error_message = None, str(task.exception())
+                else:
+                    result, error_message = task.result()
+                renders_total.inc(
+                    renderer=renderer, result="error" if result is None else "ok"
+                )
+                if result is not None:
+                    return result, None, renderer
+                errors[renderer] = error_message
+    finally:
+        for task in pending:
+            task.cancel()
+    # The service's error is the one worth showing; the local renderer knows only a subset.
+    renderer = RENDERER_SERVICE if RENDERER_SERVICE in errors else RENDERER_LOCAL
+    return None, errors[renderer], renderer
+
+
+async def render_uncached(
+    session: aiohttp.ClientSession, key: str, code: str
+) -> Tuple[Optional[bytes], Optional[str]]:
+    """Render with the tex service; raises ``ServiceUnavailable`` unless it answers."""
     params = {"latex": code}
     headers = {"Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=params, headers=headers) as r:
+    try:
+        async with session.post(
+            URL,
+            json=params,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=SERVICE_TIMEOUT),
+        ) as r:
+            if r.status >= 500:
+                raise ServiceUnavailable(await r.text())
             if r.status != 200:
                 error_message = await r.text()
-                embed = discord.Embed(
-                    title="Rendering Error",
-                    description=f"```\n{error_message}\n```",
-                    color=0xFF0000,
-                )
-                embed.set_author(
-                    name=author.name,
-                    icon_url=author.display_avatar.url,
-                )
-                return "", embed, None
-
+                render_cache.set_error(key, error_message)
+                return None, error_message
             result = await r.read()
-            file = discord.File(io.BytesIO(result), filename="tex.png", spoiler=spoiler)
-            embed = discord.Embed(color=0x008000)
-            embed.set_author(name=author.name, icon_url=author.display_avatar.url)
-            if not spoiler:
-                embed.set_image(url="attachment://tex.png")
-            if "\\\\" in code and "\\begin" not in code and "\\end" not in code:
-                embed.add_field(
-                    name="Hint", value="You can use gather or align environment."
-                )
-            return "", embed, file
+    except asyncio.TimeoutError:
+        raise ServiceUnavailable("The tex service timed out.")
+    except aiohttp.ClientError as e:
+        raise ServiceUnavailable(f"The tex service is unavailable ({e}).")
+    await render_cache.set_image(key, result)
+    return result, None
+
+
+def closing_delimiter(code: str, start: int, closing: str) -> Optional[int]:
+    """Index of the first ``closing`` at or after ``start`` outside braces and escapes."""
+    depth = 0
+    i = start
+    while i < len(code):
+        if depth == 0 and code.startswith(closing, i):
+            return i
+        if code[i] == "\\":
+            i += 2
+            continue
+        if code[i] == "{":
+            depth += 1
+        elif code[i] == "}":
+            depth -= 1
+        i += 1
+    return None
+
+
+def math_segments(code: str) -> List[str]:
+    """The formulas in ``code`` when it is only delimited formulas and whitespace, else ``[code]``.
+
+    Delimiters inside braces, as in ``\\text{if $x>0$}``, belong to the
+    formula around them.
+    """
+    segments = []
+    i = 0
+    while True:
+        while i < len(code) and code[i].isspace():
+            i += 1
+        if i == len(code):
+            break
+        for opening, closing in MATH_DELIMITERS:
+            if code.startswith(opening, i):
+                break
+        else:
+            return [code]
+        start = i + len(opening)
+        end = closing_delimiter(code, start, closing)
+        if end is None:
+            return [code]
+        segments.append(code[start:end].strip())
+        i = end + len(closing)
+    return [segment for segment in segments if segment] or [code]
+
+
+def stack_images(images: List[bytes], spacing: int = SEGMENT_SPACING) -> bytes:
+    """Stack PNGs vertically, left-aligned, on a transparent background."""
+    frames = [Image.open(io.BytesIO(image)).convert("RGBA") for image in images]
+    width = max(frame.width for frame in frames)
+    height = sum(frame.height for frame in frames) + spacing * (len(frames) - 1)
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    y = 0
+    for frame in frames:
+        canvas.paste(frame, (0, y))
+        y += frame.height + spacing
+    output = io.BytesIO()
+    canvas.save(output, format="PNG")
+    return output.getvalue()
+
+
+async def render_segments(
+    session: aiohttp.ClientSession, owner: Owner, segments: List[str]
+) -> Tuple[Optional[bytes], Optional[str], List[str]]:
+    """Render ``segments`` concurrently and stack them into one image.
+
+    Each segment is cached on its own, so editing one formula of a message
+    only renders that formula again. Also returns the renderers that answered.
+    """
+    if len(segments) == 1:
+        result, error_message, renderer = await render(session, owner, segments[0])
+        return result, error_message, [renderer]
+    results = await asyncio.gather(
+        *(render(session, owner, segment) for segment in segments)
+    )
+    renderers = sorted({renderer for _, _, renderer in results})
+    errors = [
+        f"#{i}: {error_message}"
+        for i, (result, error_message, _) in enumerate(results, 1)
+        if result is None
+    ]
+    if errors:
+        return None, "\n".join(errors), renderers
+    image = await asyncio.to_thread(stack_images, [result for result, _, _ in results])
+    return image, None, renderers
+
+
+async def respond_core(
+    session: aiohttp.ClientSession, author: discord.User, code: str, spoiler: bool
+) -> Tuple[str, discord.Embed, Optional[discord.File]]:
+    segments = math_segments(code)
+    if len(segments) > MAX_SEGMENTS:
+        embed = discord.Embed(
+            title="Too Many Formulas",
+            description=f"Up to {MAX_SEGMENTS} formulas can be rendered at once.",
+            color=0xFF0000,
+        )
+        embed.set_author(
+            name=author.name,
+            icon_url=author.display_avatar.url,
+        )
+        return "", embed, None
+    try:
+        result, error_message, renderers = await render_segments(
+            session, owner_of(author), segments
+        )
+    except Busy:
+        embed = discord.Embed(
+            title="Busy",
+            description="Too many formulas are waiting to be rendered. Please try again later.",
+            color=0xFF0000,
+        )
+        embed.set_author(
+            name=author.name,
+            icon_url=author.display_avatar.url,
+        )
+        return "", embed, None
+    if result is None:
+        embed = discord.Embed(
+            title="Rendering Error",
+            description=f"```\n{error_message}\n```",
+            color=0xFF0000,
+        )
+        embed.set_author(
+            name=author.name,
+            icon_url=author.display_avatar.url,
+        )
+        embed.set_footer(text=f"Rendered by {', '.join(renderers)}")
+        return "", embed, None
+
+    file = discord.File(io.BytesIO(result), filename="tex.png", spoiler=spoiler)
+    embed = discord.Embed(color=0x008000)
+    embed.set_author(name=author.name, icon_url=author.display_avatar.url)
+    if not spoiler:
+        embed.set_image(url="attachment://tex.png")
+    embed.set_footer(text=f"Rendered by {', '.join(renderers)}")
+    if "\\\\" in code and "\\begin" not in code and "\\end" not in code:
+        embed.add_field(
+            name="Hint", value="You can use gather or align environment."
+        )
+    return "", embed, file
 
 
 class TeXModal(discord.ui.Modal):
@@ -65,6 +425,7 @@ class TeXModal(discord.ui.Modal):
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer(invisible=False)
         content, embed, file = await respond_core(
+            interaction.client.http_session,
             interaction.user,
             self.children[0].value,
             self.spoiler,
@@ -73,7 +434,7 @@ class TeXModal(discord.ui.Modal):
             name="Code",
             value=f"```tex\n{self.children[0].value}\n```",
         )
-        view = discord.ui.View(DeleteButton(interaction.user), timeout=None)
+        view = delete_view(interaction.user)
         if file is None:
             await interaction.followup.send(
                 content=content, embed=embed, view=view, wait=True
@@ -87,36 +448,38 @@ class TeXModal(discord.ui.Modal):
 class TeX(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.user_message_id_to_bot_message = LimitedSizeDict(size_limit=100)
 
-    @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if before.content != after.content:
-            if before.id in self.user_message_id_to_bot_message:
-                await self.user_message_id_to_bot_message[before.id].delete()
+    def cog_unload(self):
+        local_renderer.close()
 
     async def respond(self, ctx: commands.Context, code: str, spoiler: bool):
+        code = code.replace("```tex", "").replace("```", "").strip()
+        key = (spoiler, render_cache.key(code))
+        if self.bot.unchanged_edit(ctx, key):
+            return
         async with ctx.channel.typing():
-            view = discord.ui.View(DeleteButton(ctx.author), timeout=None)
-            code = code.replace("```tex", "").replace("```", "").strip()
-            content, embed, file = await respond_core(ctx.author, code, spoiler)
+            view = delete_view(ctx.author)
+            content, embed, file = await respond_core(
+                self.bot.http_session, ctx.author, code, spoiler
+            )
             if file is None:
-                m = await ctx.reply(content=content, embed=embed, view=view)
+                await self.bot.replies.send(
+                    ctx, key, content=content, embed=embed, view=view
+                )
             else:
-                m = await ctx.reply(content=content, embed=embed, file=file, view=view)
-            return m
+                await self.bot.replies.send(
+                    ctx, key, content=content, embed=embed, file=file, view=view
+                )
 
     @commands.command()
     async def tex(self, ctx: commands.Context, *, code: str):
-        """LaTeX to image (in math mode)"""
-        m = await self.respond(ctx, code, False)
-        self.user_message_id_to_bot_message[ctx.message.id] = m
+        """LaTeX to image (in math mode, or one image of several $...$ formulas)"""
+        await self.respond(ctx, code, False)
 
     @commands.command()
     async def stex(self, ctx: commands.Context, *, code: str):
-        """LaTeX to spoiler image (in math mode)"""
-        m = await self.respond(ctx, code, True)
-        self.user_message_id_to_bot_message[ctx.message.id] = m
+        """LaTeX to spoiler image (in math mode, or one image of several $...$ formulas)"""
+        await self.respond(ctx, code, True)
 
     @discord.slash_command(
         name="tex",
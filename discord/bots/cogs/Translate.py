@@ -1,51 +1,372 @@
-import os
+import asyncio
+import hashlib
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter
 
 import discord
 import dotenv
 import iso639
 from discord.ext import commands
 from iso639.exceptions import InvalidLanguageValue
-from openai import AsyncOpenAI
 
-from .. import DeleteButton
+from .. import delete_view
+from ..core.autocomplete import PrefixIndex
+from ..core.cache import LRUCache
+from ..core.llm import stream_chat
+from ..core.metrics import label_set, registry
+from ..core.progressive import FIELD_LIMIT, Page, ProgressiveMessages, split_text
+from ..core.scheduler import Busy, Owner, get_scheduler, owner_of
 
 dotenv.load_dotenv(verbose=True)
+BASE_DIR = pathlib.Path(__file__).parent.parent
+MODEL = "gpt-4"
 
 
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+scheduler = get_scheduler("openai", concurrency=4, max_queued=16)
+# Fields of translated text per embed, keeping each well under the 6000-character embed limit.
+FIELDS_PER_EMBED = 4
+EMBED_CHAR_BUDGET = 4000
+# Most messages /translate_recent takes, and the size of one batched request.
+RECENT_LIMIT = 20
+BATCH_MAX_SEGMENTS = 20
+BATCH_MAX_CHARS = 3000
+SEGMENT_MARKER = re.compile(r"^<<<(\d+)>>>[ \t]*$", re.MULTILINE)
 
-two_letter_codes: dict[str, list[str]] = {}
-three_letter_codes: dict[str, list[str]] = {}
-language_names: list[str] = []
-for lang in iso639.iter_langs():
-    if not lang.pt1:
-        continue
-    if lang.pt1:
-        if lang.pt1 in two_letter_codes:
-            two_letter_codes[lang.pt1].append(lang.name)
-        else:
-            two_letter_codes[lang.pt1] = [lang.name]
-    language_names.append(f"{lang.name}")
+
+def build_language_index() -> PrefixIndex:
+    language_entries: list[tuple[str, str]] = []
+    for lang in iso639.iter_langs():
+        if not lang.pt1:
+            continue
+        language_entries.append((lang.name, lang.name))
+        language_entries.append((lang.pt1, lang.name))
+        if lang.pt3:
+            language_entries.append((lang.pt3, lang.name))
+    return PrefixIndex(language_entries)
+
+
+class TranslationCache:
+    """Translations keyed by a hash of the normalized text, the target language and the model.
+
+    Recent ones live in an in-memory LRU holding at most ``max_memory_bytes``
+    of UTF-8, backed by a SQLite table at ``path``, where rows expire after
+    ``ttl`` seconds. Every 100 writes, expired rows and all but the newest
+    ``max_rows`` are deleted.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        max_memory_bytes: int = 4 * 1024 * 1024,
+        ttl: float = 30 * 24 * 60 * 60,
+        max_rows: int = 100000,
+    ):
+        self.path = path
+        self.memory = LRUCache(max_memory_bytes, sizeof=lambda text: len(text.encode()))
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.stats = Counter()
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @staticmethod
+    def key(text: str, language: str, model: str) -> str:
+        normalized = "\n".join(
+            re.sub(r"\s+", " ", line).strip() for line in text.strip().splitlines()
+        )
+        return hashlib.sha256(
+            "\0".join((normalized, language, model)).encode()
+        ).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, from a worker thread; every use holds self._lock.
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            # Cluster processes share the file.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS translations "
+                "(key TEXT PRIMARY KEY, translation TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS translations_created_at ON translations (created_at)"
+            )
+            self._connection = connection
+        return self._connection
+
+    def _read(self, key: str) -> str | None:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT translation FROM translations WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write(self, key: str, translation: str):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                    (key, translation, time.time()),
+                )
+                self._writes += 1
+                if self._writes % 100 == 1:
+                    self._prune(connection)
+
+    def _prune(self, connection: sqlite3.Connection):
+        connection.execute(
+            "DELETE FROM translations WHERE created_at <= ?", (time.time() - self.ttl,)
+        )
+        connection.execute(
+            "DELETE FROM translations WHERE key IN (SELECT key FROM translations "
+            "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+
+    async def get(self, key: str) -> str | None:
+        translation = self.memory.get(key)
+        if translation is not None:
+            self.stats["memory_hits"] += 1
+            return translation
+        try:
+            translation = await asyncio.to_thread(self._read, key)
+        except sqlite3.Error:
+            traceback.print_exc()
+            translation = None
+        if translation is not None:
+            self.stats["disk_hits"] += 1
+            self.memory.set(key, translation)
+            return translation
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, translation: str):
+        self.memory.set(key, translation)
+        try:
+            await asyncio.to_thread(self._write, key, translation)
+        except sqlite3.Error:
+            traceback.print_exc()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+
+
+translation_cache = TranslationCache(BASE_DIR / "data" / "translations.sqlite3")
+registry.counter(
+    "translate_cache_lookups_total",
+    "Translation cache lookups, by result.",
+    lambda: {label_set(result=k): v for k, v in translation_cache.stats.items()},
+)
+batch_results = registry.counter(
+    "translate_batches_total",
+    "Batched translation requests, by whether the reply split back into its segments.",
+)
+registry.gauge(
+    "translate_cache_hit_ratio",
+    "Share of translation cache lookups served without calling the model.",
+    lambda: (
+        1 - translation_cache.stats["misses"] / sum(translation_cache.stats.values())
+        if translation_cache.stats
+        else None
+    ),
+)
+
+
+def resolve_language(value: str) -> iso639.Lang | None:
+    try:
+        lang = iso639.Lang(value)
+    except InvalidLanguageValue:
+        return None
+    return lang if lang.pt1 else None
+
+
+def system_prompt(language: str) -> str:
+    return (
+        "This is a direct translation task. "
+        f"Translate the following text to {language}. "
+        "Do not add any additional comments or language indicators."
+    )
+
+
+def batch_system_prompt(language: str) -> str:
+    return (
+        system_prompt(language)
+        + " The text is split into segments, each introduced by a marker line such as <<<1>>>. "
+        "Translate every segment on its own and keep each marker line unchanged, in order."
+    )
+
+
+def pack_segments(texts: list[str]) -> str:
+    return "\n".join(f"<<<{i}>>>\n{text}" for i, text in enumerate(texts, 1))
+
+
+def unpack_segments(reply: str, count: int) -> list[str] | None:
+    """The translations in a reply to ``pack_segments``, or ``None`` if its markers came back broken."""
+    parts = SEGMENT_MARKER.split(reply)
+    if parts[0].strip() or [int(i) for i in parts[1::2]] != list(range(1, count + 1)):
+        return None
+    segments = [part.strip() for part in parts[2::2]]
+    return segments if all(segments) else None
+
+
+def batches(texts: list[str]) -> list[list[int]]:
+    """Indices of ``texts`` grouped into requests of at most ``BATCH_MAX_SEGMENTS`` segments and about ``BATCH_MAX_CHARS``."""
+    groups, group, size = [], [], 0
+    for i, text in enumerate(texts):
+        if group and (len(group) >= BATCH_MAX_SEGMENTS or size + len(text) > BATCH_MAX_CHARS):
+            groups.append(group)
+            group, size = [], 0
+        group.append(i)
+        size += len(text)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def translation_pages(text: str, to: str, translated: str) -> list[Page]:
+    """One embed per message; the translation is split over fields and, when long, messages."""
+    pages = []
+    pieces = split_text(translated, FIELD_LIMIT)
+    for start in range(0, len(pieces), FIELDS_PER_EMBED):
+        embed = discord.Embed(
+            title="Translate",
+            color=discord.Color.blurple(),
+        )
+        if start == 0:
+            embed.add_field(
+                name=f"Original text",
+                value=text if len(text) <= FIELD_LIMIT else text[:FIELD_LIMIT - 1] + "…",
+                inline=False,
+            )
+        for i, piece in enumerate(pieces[start:start + FIELDS_PER_EMBED], start):
+            embed.add_field(
+                name=f"Translated to {to}" + (" (continued)" if i else ""),
+                value=piece,
+                inline=False,
+            )
+        pages.append({"embed": embed})
+    return pages
+
+
+def batch_pages(entries: list[tuple[str, str]], to: str) -> list[Page]:
+    """Embeds of ``(author, translation)`` pairs, one field each (more when long), spread over messages."""
+    pages = []
+    embed, size = None, 0
+    for name, translated in entries:
+        for i, piece in enumerate(split_text(translated, FIELD_LIMIT)):
+            if embed is None or len(embed.fields) >= 25 or size + len(piece) > EMBED_CHAR_BUDGET:
+                embed = discord.Embed(
+                    title=f"Translated to {to}",
+                    color=discord.Color.blurple(),
+                )
+                pages.append({"embed": embed})
+                size = 0
+            embed.add_field(
+                name=name + (" (continued)" if i else ""),
+                value=piece,
+                inline=False,
+            )
+            size += len(piece)
+    return pages
 
 
 def autocomplete_language(ctx: discord.AutocompleteContext) -> list[str]:
-    input_value = ctx.value.lower()
-    if len(input_value) <= 1:
+    if not ctx.value:
         return []
-    elif len(input_value) == 2:
-        return two_letter_codes.get(input_value, [])
-    elif len(input_value) == 3:
-        return three_letter_codes.get(input_value, [])
-    else:
-        matching_languages = [
-            name for name in language_names if name.lower().startswith(input_value)
-        ]
-        return sorted(matching_languages, key=len)[:30]
+    return ctx.cog.languages().search(ctx.value)
 
 
 class Translate(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.language_index: PrefixIndex | None = None
+
+    def cog_unload(self):
+        translation_cache.close()
+
+    async def startup(self):
+        index = await asyncio.to_thread(build_language_index)
+        if self.language_index is None:
+            self.language_index = index
+
+    def languages(self) -> PrefixIndex:
+        # Built by startup(); only an autocomplete racing it builds it inline.
+        if self.language_index is None:
+            self.language_index = build_language_index()
+        return self.language_index
+
+    async def complete(self, system: str, text: str, max_tokens: int = 2000) -> str:
+        response = await self.bot.openai.chat.completions.create(
+            model=MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": system,
+                },
+                {
+                    "role": "user",
+                    "content": text,
+                },
+            ],
+            max_tokens=max_tokens,
+        )
+        return (response.choices[0].message.content or "").strip()
+
+    async def translate_batch(self, owner: Owner, texts: list[str], lang: iso639.Lang) -> list[str]:
+        """Translate ``texts`` in one model call, or one call each if the reply cannot be split back.
+
+        Every call holds its own scheduler slot; the fallback calls run one at
+        a time, so a broken batch costs no more concurrency than a single call.
+        """
+        if len(texts) > 1:
+            async with scheduler.slot(owner):
+                reply = await self.complete(
+                    batch_system_prompt(lang.name), pack_segments(texts), max_tokens=4000
+                )
+            translations = unpack_segments(reply, len(texts))
+            batch_results.inc(result="ok" if translations is not None else "broken")
+            if translations is not None:
+                return translations
+        translations = []
+        for text in texts:
+            async with scheduler.slot(owner):
+                translations.append(await self.complete(system_prompt(lang.name), text))
+        return translations
+
+    async def translate_many(self, owner: Owner, texts: list[str], lang: iso639.Lang) -> list[str]:
+        """Translate ``texts``, taking cached ones from the cache and batching the rest."""
+        keys = [translation_cache.key(text, lang.pt1, MODEL) for text in texts]
+        cached = await asyncio.gather(*(translation_cache.get(key) for key in keys))
+        translations = dict(zip(keys, cached))
+        missing = {key: text for key, text in zip(keys, texts) if translations[key] is None}
+        missing_keys, missing_texts = list(missing), list(missing.values())
+
+        async def run(batch: list[int]):
+            translated = await self.translate_batch(owner, [missing_texts[i] for i in batch], lang)
+            for i, translation in zip(batch, translated):
+                translations[missing_keys[i]] = translation
+                if translation:
+                    await translation_cache.set(missing_keys[i], translation)
+
+        tasks = [asyncio.ensure_future(run(batch)) for batch in batches(missing_texts)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # When one batch fails (e.g. with Busy) the others are not wanted either.
+            for task in tasks:
+                task.cancel()
+        return [translations[key] or "…" for key in keys]
 
     @discord.slash_command(
         name="translate",
@@ -76,44 +397,110 @@ class Translate(commands.Cog):
     async def translate(self, ctx: discord.ApplicationContext, text: str, to: str):
         """Translate text"""
         await ctx.defer()
-        try:
-            lang = iso639.Lang(to)
-        except InvalidLanguageValue:
-            return await ctx.followup.send("Invalid language", ephemeral=True)
-        if not lang.pt1:
+        lang = resolve_language(to)
+        if lang is None:
             return await ctx.followup.send("Invalid language", ephemeral=True)
-        response = await client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "This is a direct translation task. "
-                    f"Translate the following text to {lang.name}. "
-                    "Do not add any additional comments or language indicators.",
-                },
-                {
-                    "role": "user",
-                    "content": text,
-                },
-            ],
-            max_tokens=2000,
-        )
-        embed = discord.Embed(
-            title="Translate",
-            color=discord.Color.blurple(),
-        )
-        embed.add_field(
-            name=f"Original text",
-            value=text,
-            inline=False,
+        view = delete_view(ctx.user)
+        # The first tokens replace the "thinking" message at once; the rest are edited in.
+        replies = ProgressiveMessages(
+            lambda **page: ctx.followup.send(view=view, wait=True, **page)
         )
-        embed.add_field(
-            name=f"Translated to {to}",
-            value=response.choices[0].message.content,
-            inline=False,
-        )
-        view = discord.ui.View(DeleteButton(ctx.user))
-        await ctx.followup.send(embed=embed, view=view)
+        key = translation_cache.key(text, lang.pt1, MODEL)
+        cached = await translation_cache.get(key)
+        if cached is not None:
+            return await replies.finish(translation_pages(text, to, cached))
+        translated = ""
+        try:
+            async with scheduler.slot(owner_of(ctx.author)):
+                async for translated in stream_chat(
+                    self.bot.openai,
+                    model=MODEL,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": system_prompt(lang.name),
+                        },
+                        {
+                            "role": "user",
+                            "content": text,
+                        },
+                    ],
+                    max_tokens=2000,
+                ):
+                    if translated.strip():
+                        await replies.update(translation_pages(text, to, translated))
+        except Busy:
+            return await ctx.followup.send("Busy, please try again later", ephemeral=True)
+        await replies.finish(translation_pages(text, to, translated.strip() or "…"))
+        if translated.strip():
+            await translation_cache.set(key, translated.strip())
+
+    @discord.message_command(name="Translate")
+    async def translate_message(self, ctx: discord.ApplicationContext, message: discord.Message):
+        """Translate a message to the invoking user's language"""
+        if not message.content:
+            return await ctx.respond("Nothing to translate", ephemeral=True)
+        await ctx.defer()
+        lang = resolve_language((ctx.locale or "en").split("-")[0]) or iso639.Lang("en")
+        try:
+            [translated] = await self.translate_many(owner_of(ctx.author), [message.content], lang)
+        except Busy:
+            return await ctx.followup.send("Busy, please try again later", ephemeral=True)
+        view = delete_view(ctx.user)
+        await ProgressiveMessages(
+            lambda **page: ctx.followup.send(view=view, wait=True, **page)
+        ).finish(translation_pages(message.content, lang.name, translated))
+
+    @discord.slash_command(
+        name="translate_recent",
+        description="Translate the latest messages in this channel",
+        description_localizations={
+            "ja": "このチャンネルの直近のメッセージを翻訳します",
+        },
+        options=[
+            discord.Option(
+                int,
+                name="count",
+                description="Number of messages",
+                min_value=1,
+                max_value=RECENT_LIMIT,
+                required=True,
+            ),
+            discord.Option(
+                name="to",
+                description="Language to translate to",
+                autocomplete=autocomplete_language,
+                required=True,
+            ),
+        ],
+    )
+    async def translate_recent(self, ctx: discord.ApplicationContext, count: int, to: str):
+        """Translate the latest messages in this channel"""
+        await ctx.defer()
+        lang = resolve_language(to)
+        if lang is None:
+            return await ctx.followup.send("Invalid language", ephemeral=True)
+        history = await ctx.channel.history(limit=count).flatten()
+        history.reverse()
+        messages = [
+            message for message in history
+            if message.content and message.author.id not in self.bot.opt_out_users
+        ]
+        if not messages:
+            return await ctx.followup.send("Nothing to translate", ephemeral=True)
+        try:
+            translations = await self.translate_many(
+                owner_of(ctx.author), [message.content for message in messages], lang
+            )
+        except Busy:
+            return await ctx.followup.send("Busy, please try again later", ephemeral=True)
+        view = delete_view(ctx.user)
+        await ProgressiveMessages(
+            lambda **page: ctx.followup.send(view=view, wait=True, **page)
+        ).finish(batch_pages(
+            [(message.author.display_name, translation) for message, translation in zip(messages, translations)],
+            to,
+        ))
 
 
 def setup(bot):
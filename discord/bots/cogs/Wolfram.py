@@ -1,93 +1,166 @@
+import asyncio
 import os
 import pathlib
-from collections import OrderedDict
+from typing import List, Optional, Tuple
 
-import aiohttp
 import discord
 import dotenv
 from discord.ext import commands, pages
 
-from .. import SUPPORT_SERVER_LINK, DeleteButton
+from .. import SUPPORT_SERVER_LINK, delete_view
+from ..core.coalesce import Coalescer
+from ..core.scheduler import Busy, Owner, get_scheduler, owner_of
 
 dotenv.load_dotenv(verbose=True)
 URL = 'http://api.wolframalpha.com/v2/query'
+# Pods are requested a few at a time; later batches are fetched on demand by PodPaginator.
+POD_BATCH_SIZE = 3
+POD_SCAN_TIMEOUT = 2
 BASE_DIR = pathlib.Path(__file__).parent.parent
 
 
-class LimitedSizeDict(OrderedDict):
-
-    def __init__(self, size_limit=None, *args, **kwds):
-        self.size_limit = size_limit
-        super().__init__(*args, **kwds)
-        self._check_size_limit()
-
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        self._check_size_limit()
-
-    def _check_size_limit(self):
-        if self.size_limit is not None:
-            while len(self) > self.size_limit:
-                self.popitem(last=False)
+def pod_pages(pods: List[dict], author: discord.User) -> List[discord.Embed]:
+    page_list = []
+    for pod in pods:
+        for subpod in pod['subpods']:
+            embed = discord.Embed(
+                title=pod['title'],
+                description=subpod['plaintext'],
+                color=0x00ff00,
+            )
+            if 'img' in subpod:
+                embed.set_image(url=subpod['img']['src'])
+                embed.set_author(name=author.name, icon_url=author.display_avatar.url)
+            page_list.append(embed)
+    return page_list
+
+
+class PodPaginator(pages.Paginator):
+    """Paginator that fetches the next batch of pods only when the user pages past the loaded ones.
+
+    While more pods may exist, a placeholder page is kept at the end so the
+    "next" button stays enabled. Batches can come back short when pods time out
+    (see ``POD_SCAN_TIMEOUT``), so only an empty batch ends the results.
+    """
+
+    def __init__(self, cog: 'Wolfram', author: discord.User, query: str, page_list: List[discord.Embed], next_pod: Optional[int]):
+        self.cog = cog
+        self.author = author
+        self.query = query
+        self.next_pod = next_pod
+        self.loading = asyncio.Lock()
+        if next_pod is not None:
+            page_list = page_list + [self.placeholder_page()]
+        super().__init__(pages=page_list)
+
+    @staticmethod
+    def placeholder_page() -> discord.Embed:
+        return discord.Embed(title='Loading more results...', color=0x00ff00)
+
+    async def load_more(self):
+        try:
+            status, data = await self.cog.query_pods(self.query, self.next_pod, owner_of(self.author))
+        except Busy:
+            # Keep the placeholder so paging on retries the fetch.
+            return
+        pods = data['queryresult'].get('pods', []) if data and data['queryresult']['success'] else []
+        page_list = self.pages[:-1] + pod_pages(pods, self.author)
+        if pods:
+            self.next_pod += POD_BATCH_SIZE
+            page_list.append(self.placeholder_page())
+        else:
+            self.next_pod = None
+        self.pages = page_list
+        self.page_count = max(len(self.pages) - 1, 0)
+
+    async def goto_page(self, page_number: int = 0, *, interaction: Optional[discord.Interaction] = None):
+        if self.next_pod is not None and page_number >= len(self.pages) - 1:
+            if interaction:
+                # Fetching can take longer than the interaction deadline, so acknowledge it first.
+                await interaction.response.defer()
+                interaction = None
+            async with self.loading:
+                if self.next_pod is not None and page_number >= len(self.pages) - 1:
+                    await self.load_more()
+            page_number = min(page_number, self.page_count)
+        await super().goto_page(page_number, interaction=interaction)
 
 
 class Wolfram(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.user_message_id_to_bot_message = LimitedSizeDict(size_limit=100)
-
-    @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if before.content != after.content:
-            if before.id in self.user_message_id_to_bot_message:
-                await self.user_message_id_to_bot_message[before.id].delete()
-
-    @commands.Cog.listener()
-    async def on_message_delete(self, message: discord.Message):
-        if message.id in self.user_message_id_to_bot_message:
-            await self.user_message_id_to_bot_message[message.id].delete()
-
+        self.queries = Coalescer()
+        self.scheduler = get_scheduler('wolfram', concurrency=4, max_queued=32)
+
+    async def query(self, params: dict, owner: Owner) -> Tuple[int, Optional[dict]]:
+        async def get():
+            async with self.bot.http_session.get(URL, params={**params, 'appid': os.environ.get('WOLFRAM_APPID')}) as resp:
+                if resp.status != 200:
+                    return resp.status, None
+                return resp.status, await resp.json()
+
+        return await self.queries.run(tuple(sorted(params.items())), lambda: self.scheduler.run(owner, get))
+
+    async def query_pods(self, query: str, first_pod: int, owner: Owner) -> Tuple[int, Optional[dict]]:
+        return await self.query({
+            'input': query,
+            'format': 'image,plaintext',
+            'output': 'JSON',
+            'podindex': ','.join(str(i) for i in range(first_pod, first_pod + POD_BATCH_SIZE)),
+            'scantimeout': str(POD_SCAN_TIMEOUT),
+        }, owner)
 
     @commands.command(aliases=['wolfram'])
     async def wolf(self, ctx: commands.Context, *, query: str):
+        key = ' '.join(query.split())
+        if self.bot.unchanged_edit(ctx, key):
+            return
 
         async with ctx.channel.typing():
-            view = discord.ui.View(DeleteButton(ctx.author), timeout=None)
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(URL, params={'input': query, 'format': 'image,plaintext', 'output': 'JSON', 'appid': os.environ.get('WOLFRAM_APPID')}) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                    else:
-                        embed = discord.Embed(
-                            title='Connection Error',
-                            description=f'{resp.status}',
-                            color=0xff0000
-                        )
-                        embed.set_author(
-                            name=ctx.author.name,
-                            icon_url=ctx.author.display_avatar.url
-                        )
-                        self.user_message_id_to_bot_message[ctx.message.id] = await ctx.reply(content=f'Please Report us!\n{SUPPORT_SERVER_LINK}', embed=embed, view=view)
-                        return
-
-            page_list = []
+            view = delete_view(ctx.author)
+
+            try:
+                status, data = await self.query_pods(query, 1, owner_of(ctx.author))
+            except Busy:
+                embed = discord.Embed(
+                    title='Busy',
+                    description='Too many queries are waiting. Please try again later.',
+                    color=0xff0000
+                )
+                embed.set_author(
+                    name=ctx.author.name,
+                    icon_url=ctx.author.display_avatar.url
+                )
+                await self.bot.replies.send(ctx, key, content=None, embed=embed, view=view)
+                return
+            if data is None:
+                embed = discord.Embed(
+                    title='Connection Error',
+                    description=f'{status}',
+                    color=0xff0000
+                )
+                embed.set_author(
+                    name=ctx.author.name,
+                    icon_url=ctx.author.display_avatar.url
+                )
+                await self.bot.replies.send(ctx, key, content=f'Please Report us!\n{SUPPORT_SERVER_LINK}', embed=embed, view=view)
+                return
+
             if data['queryresult']['success']:
-                for pod in data['queryresult']['pods']:
-                    for subpod in pod['subpods']:
-                        embed = discord.Embed(
-                            title=pod['title'],
-                            description=subpod['plaintext'],
-                            color=0x00ff00,
-                        )
-                        if 'img' in subpod:
-                            embed.set_image(url=subpod['img']['src'])
-                            embed.set_author(name=ctx.author.name, icon_url=ctx.author.display_avatar.url)
-                        page_list.append(embed)
-                paginator = pages.Paginator(pages=page_list)
+                pods = data['queryresult'].get('pods', [])
+                paginator = PodPaginator(
+                    self, ctx.author, query, pod_pages(pods, ctx.author),
+                    next_pod=1 + POD_BATCH_SIZE if pods else None,
+                )
                 # paginator.add_button(DeleteButton(self.bot))
-                m = await paginator.send(ctx)
+                previous = self.bot.replies.get(ctx.message.id)
+                m = None
+                if previous is not None:
+                    m = await paginator.edit(previous.message, user=ctx.author)
+                if m is None:
+                    m = await paginator.send(ctx)
+                self.bot.replies.track(ctx.message.id, m, key)
             else:
                 embed = discord.Embed(
                     title='Error',
@@ -98,8 +171,8 @@ class Wolfram(commands.Cog):
                     name=ctx.author.name,
                     icon_url=ctx.author.display_avatar.url
                 )
-                m = await ctx.reply(embed=embed, view=view)
-            self.user_message_id_to_bot_message[ctx.message.id] = m
+                await self.bot.replies.send(ctx, key, content=None, embed=embed, view=view)
+
 
 def setup(bot):
     return bot.add_cog(Wolfram(bot))
@@ -0,0 +1,46 @@
+import bisect
+import heapq
+from typing import Iterable, List, Tuple
+
+from .. import LimitedSizeDict
+
+# Discord rejects autocomplete responses with more than 25 choices.
+MAX_CHOICES = 25
+
+
+class PrefixIndex:
+    """Sorted-array prefix index for slash-command autocomplete.
+
+    ``entries`` are ``(key, value)`` pairs: ``key`` is matched case-insensitively
+    against the typed prefix and ``value`` is the choice shown to the user.
+    Several keys (a name and its codes) may point to the same value.
+    Results are ranked exact key match first, then shorter values, and
+    recent prefixes are served from a small LRU.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, str]], limit: int = MAX_CHOICES, cache_size: int = 256):
+        pairs = sorted({(key.lower(), value) for key, value in entries})
+        self.keys = [key for key, _ in pairs]
+        self.values = [value for _, value in pairs]
+        self.limit = limit
+        self.cache = LimitedSizeDict(size_limit=cache_size)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def search(self, prefix: str) -> List[str]:
+        prefix = prefix.lower()
+        if prefix in self.cache:
+            self.cache.move_to_end(prefix)
+            return self.cache[prefix]
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\uffff', lo=start)
+        ranks = {}
+        for i in range(start, end):
+            value = self.values[i]
+            rank = (self.keys[i] != prefix, len(value), value)
+            if value not in ranks or rank < ranks[value]:
+                ranks[value] = rank
+        result = heapq.nsmallest(self.limit, ranks, key=ranks.get)
+        self.cache[prefix] = result
+        return result
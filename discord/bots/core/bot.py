@@ -1,60 +1,222 @@
+import asyncio
 import copy
 import io
 import os
 import pathlib
 import pprint
+import time
 import traceback
 from typing import Union
 
 import discord
 from discord.ext import commands
 
-from .. import DEVELOPER_ID, LOG_CHANNEL_ID, SUPPORT_SERVER_LINK, DeleteButton
+from .. import DEVELOPER_ID, LOG_CHANNEL_ID, SUPPORT_SERVER_LINK, DeleteButton, delete_view
+from .http import HTTPSessionPool
+from .llm import OpenAIClient
+from .memory import MemoryReporter, client_options, resident_memory
+from .metrics import LoopLagMonitor, MetricsServer, http_trace_config, label_set, registry
+from .optout import OptOutRegistry
+from .ratelimit import COMMAND_CLASSES, RateLimited, RateLimiter
+from .replies import ReplyRegistry
 
 BASE_DIR = pathlib.Path(__file__).parent.parent
 
+command_seconds = registry.histogram('command_seconds', 'Time to run a command, by command and kind.')
+command_errors = registry.counter('command_errors_total', 'Command errors, by command and exception type.')
 
-class Bot(commands.Bot):
-    def __init__(self, token, cogs, prefix):
+
+class Bot(commands.AutoShardedBot):
+    """The bot, sharded automatically unless ``shard_ids`` and ``shard_count`` are given.
+
+    State kept in memory (tracked replies, rate-limit buckets, caches) is per
+    process. Everything about one guild arrives on one shard, so guild-scoped
+    state stays consistent when shards are spread over clusters, while
+    per-user rate limits apply per cluster.
+    """
+
+    def __init__(self, token, cogs, prefix, rate_limits=None, shard_ids=None, shard_count=None, memory_profile=None,
+                 data_dir=BASE_DIR / 'data'):
+        self.started_at = time.perf_counter()
         self.token = token
-        intents = discord.Intents.default()
-        intents.message_content = True
-        super().__init__(command_prefix=prefix, intents=intents)
+        # MEMORY_PROFILE=low trims intents and caches; see core/memory.py.
+        memory_profile = memory_profile or os.environ.get('MEMORY_PROFILE', 'default')
+        super().__init__(
+            command_prefix=prefix,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+            **client_options(memory_profile),
+        )
+        self.opt_out_users = OptOutRegistry(pathlib.Path(data_dir) / 'opt-out-users.txt')
+        self.http_pool = HTTPSessionPool(trace_configs=[http_trace_config()])
+        self.openai_client = OpenAIClient()
+        self.startup_task = None
+        self.replies = ReplyRegistry()
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.loop_lag = LoopLagMonitor()
+        # Set MEMORY_REPORT_INTERVAL (seconds) to print resident memory per guild.
+        memory_report_interval = os.environ.get('MEMORY_REPORT_INTERVAL')
+        self.memory_reporter = (
+            MemoryReporter(lambda: len(self.guilds), float(memory_report_interval))
+            if memory_report_interval else None
+        )
+        # Set METRICS_PORT to serve Prometheus metrics at /metrics.
+        metrics_port = os.environ.get('METRICS_PORT')
+        self.metrics_server = (
+            MetricsServer(registry, os.environ.get('METRICS_HOST', '127.0.0.1'), int(metrics_port))
+            if metrics_port else None
+        )
+        self.register_metrics()
+        self.add_listener(self.on_delete_button, 'on_interaction')
+        self.before_invoke(self.before_command)
+        self.after_invoke(self.observe_command)
         self.load_cogs(cogs)
 
+    @property
+    def http_session(self):
+        return self.http_pool.session
+
+    @property
+    def openai(self):
+        return self.openai_client.client
+
+    def take_rate_limit(self, ctx: Union[commands.Context, discord.ApplicationContext]):
+        """Take a token for running ``ctx.command``, or raise ``RateLimited``."""
+        command_class = COMMAND_CLASSES.get(ctx.command.qualified_name)
+        if command_class is not None:
+            self.rate_limiter.hit(command_class, ctx.author.id, ctx.guild.id if ctx.guild else None)
+
+    def unchanged_edit(self, ctx: commands.Context, key) -> bool:
+        """Whether ``ctx`` is a re-run for an edit that left the command's input ``key`` as it was.
+
+        Re-runs for edits are rate limited here, once they are known to do
+        work, instead of in ``before_command``. A run that goes ahead cancels
+        the one for the message's previous content, if that is still going.
+        """
+        if self.replies.unchanged(ctx.message.id, key):
+            return True
+        if getattr(ctx, 'edited', False):
+            self.take_rate_limit(ctx)
+        self.replies.supersede(ctx.message.id)
+        return False
+
+    def register_metrics(self):
+        registry.gauge('discord_gateway_latency_seconds', 'Gateway websocket heartbeat latency, by shard.', lambda: {
+            label_set(shard=shard_id): latency for shard_id, latency in self.latencies
+        })
+        registry.gauge('event_loop_lag_seconds', 'How late the event loop last woke a sleeping task.', lambda: self.loop_lag.lag)
+        registry.gauge('tracked_messages', 'Replies remembered for edit and delete handling.', lambda: len(self.replies))
+        registry.gauge('views', 'Views attached to messages and kept in memory.', lambda: len(self._connection._view_store._synced_message_views))
+        registry.gauge('guilds', 'Guilds the bot is in.', lambda: len(self.guilds))
+        registry.gauge('process_resident_memory_bytes', 'Resident memory of this process.', resident_memory)
+        registry.gauge('cached_messages', 'Messages held in the client message cache.', lambda: len(self.cached_messages))
+
+    async def before_command(self, ctx: Union[commands.Context, discord.ApplicationContext]):
+        # A hook rather than a check: checks also run for ]help, which would
+        # take tokens for every command listed.
+        if not getattr(ctx, 'edited', False):
+            self.take_rate_limit(ctx)
+        ctx.started_at = time.perf_counter()
+
+    async def observe_command(self, ctx: Union[commands.Context, discord.ApplicationContext]):
+        started_at = getattr(ctx, 'started_at', None)
+        if started_at is not None:
+            kind = 'prefix' if isinstance(ctx, commands.Context) else 'application'
+            command_seconds.observe(time.perf_counter() - started_at, command=ctx.command.qualified_name, kind=kind)
+
+    def count_error(self, ctx: Union[commands.Context, discord.ApplicationContext], exception: Exception):
+        exception = getattr(exception, 'original', exception)
+        command = ctx.command.qualified_name if ctx.command else ''
+        command_errors.inc(command=command, error=type(exception).__name__)
+
     def load_cogs(self, cogs):
         for cog in cogs:
+            started = time.perf_counter()
             self.load_extension(cog)
-            print('Loaded ' + cog)
+            print(f'Loaded {cog} in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+    async def run_startup(self):
+        """Run every cog's ``async def startup(self)`` concurrently, once, after login.
+
+        Startup work must not need the gateway cache; a failing cog is logged
+        and does not hold up the others.
+        """
+
+        async def run(name, startup):
+            started = time.perf_counter()
+            try:
+                await startup()
+            except Exception:
+                print(f'Startup of {name} failed')
+                traceback.print_exc()
+                return
+            print(f'Started {name} in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+        await asyncio.gather(*(
+            run(name, cog.startup) for name, cog in self.cogs.items() if hasattr(cog, 'startup')
+        ))
 
     async def on_ready(self):
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
+        print(f'Logged in as {self.user} (ID: {self.user.id}), ready {time.perf_counter() - self.started_at:.2f}s after start')
         print(f'Pycord Version: {discord.__version__}')
-        self.logging_channel = self.get_channel(LOG_CHANNEL_ID)
-        self.developer = self.get_user(DEVELOPER_ID)
+        # The log channel's guild may be on another cluster's shards.
+        self.logging_channel = self.get_channel(LOG_CHANNEL_ID) or await self.fetch_channel(LOG_CHANNEL_ID)
+        self.developer = self.get_user(DEVELOPER_ID) or await self.fetch_user(DEVELOPER_ID)
 
 
     async def on_message(self, message):
-        opt_out_users = []
-        if os.path.exists(BASE_DIR / 'data' / 'opt-out-users.txt'):
-            with open(BASE_DIR / 'data' / 'opt-out-users.txt', 'r') as f:
-                for line in f.readlines():
-                    if line.strip():
-                        opt_out_users.append(int(line))
-        if message.author.id in opt_out_users:
+        if message.author.id in self.opt_out_users:
             return
         await super().on_message(message)
 
-    async def on_message_edit(self, before, after):
-        if before.content == after.content:
+    # Raw events fire for messages outside the message cache too, which under
+    # MEMORY_PROFILE=low holds far fewer messages than self.replies tracks.
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if 'content' not in payload.data:
+            return
+        if payload.cached_message is not None:
+            if payload.cached_message.content == payload.data['content']:
+                return
+        elif payload.data.get('edited_timestamp') is None:
+            # Not an edit by the author, e.g. embeds being added to a link.
+            return
+        after = payload.new_message
+        if after.author.bot or after.author.id in self.opt_out_users:
+            return
+        ctx = await self.get_context(after)
+        if ctx.valid:
+            # The command edits its tracked reply in place.
+            ctx.edited = True
+            await self.invoke(ctx)
+        else:
+            await self.replies.delete(after.id)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        await self.replies.delete(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            await self.replies.delete(message_id)
+
+    async def on_delete_button(self, interaction: discord.Interaction):
+        if interaction.type is not discord.InteractionType.component:
             return
-        await self.on_message(after)
+        owner_id = DeleteButton.owner_id(interaction.data.get('custom_id', ''))
+        if owner_id is not None and owner_id == interaction.user.id:
+            await interaction.message.delete()
 
     async def on_command_error(self, ctx, exception):
+        self.count_error(ctx, exception)
         if isinstance(exception, commands.CommandNotFound):
             return
+        # Re-runs for edits are limited from inside the command; see unchanged_edit.
+        limited = getattr(exception, 'original', exception)
+        if isinstance(limited, RateLimited):
+            if limited.notify:
+                await ctx.message.add_reaction('\N{HOURGLASS WITH FLOWING SAND}')
+            return
         if isinstance(exception, commands.UserInputError):
-            view = discord.ui.View(DeleteButton(ctx.author), timeout=None)
+            view = delete_view(ctx.author)
             embed = discord.Embed(
                 title='Invalid Input',
                 description=f'```\n{exception}\n```',
@@ -66,7 +228,7 @@ class Bot(commands.Bot):
             )
             await ctx.reply(embed=embed, view=view)
             return
-        view = discord.ui.View(DeleteButton(ctx.author), timeout=None)
+        view = delete_view(ctx.author)
         embed = discord.Embed(
             title='Unhandled Error',
             color=0xff0000,
@@ -79,6 +241,13 @@ class Bot(commands.Bot):
         await self.log_error(ctx, exception)
         return await super().on_command_error(ctx, exception)
 
+    async def on_application_command_error(self, ctx: discord.ApplicationContext, exception: discord.DiscordException):
+        self.count_error(ctx, exception)
+        if isinstance(exception, RateLimited):
+            await ctx.respond(str(exception), ephemeral=True)
+            return
+        return await super().on_application_command_error(ctx, exception)
+
     async def on_slash_command_error(self, ctx: discord.ApplicationContext, exception: Exception):
         await self.log_error(ctx, exception)
         return await super().on_slash_command_error(ctx, exception)
@@ -91,6 +260,28 @@ class Bot(commands.Bot):
         exception_text = ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
         await self.logging_channel.send(content=f'```\n{content}\n```', file=discord.File(io.StringIO(exception_text), filename='error.txt'))
 
+    async def start(self, token, *, reconnect=True):
+        self.loop_lag.start()
+        if self.memory_reporter is not None:
+            self.memory_reporter.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        await self.login(token)
+        print(f'Authenticated {time.perf_counter() - self.started_at:.2f}s after start')
+        if self.startup_task is None:
+            self.startup_task = asyncio.create_task(self.run_startup())
+        await self.connect(reconnect=reconnect)
+
+    async def close(self):
+        self.loop_lag.stop()
+        if self.memory_reporter is not None:
+            self.memory_reporter.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.http_pool.close()
+        await self.openai_client.close()
+        await super().close()
+
     def run(self):
         try:
             self.loop.run_until_complete(self.start(self.token))
@@ -98,6 +289,7 @@ class Bot(commands.Bot):
             print('Invalid Discord Token')
         except KeyboardInterrupt:
             print('Shutdown')
-            self.loop.run_until_complete(self.close())
         except:
             traceback.print_exc()
+        finally:
+            self.loop.run_until_complete(self.close())
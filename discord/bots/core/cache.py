@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """In-memory LRU bounded by the total size of its values.
+
+    ``sizeof`` measures a value (``len`` by default, i.e. bytes for ``bytes``
+    and characters for ``str``). Entries may carry their own TTL, and their
+    number may be capped with ``max_entries``.
+    """
+
+    def __init__(self, max_size: int, sizeof: Callable[[Any], int] = len, max_entries: Optional[int] = None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.max_entries = max_entries
+        self.size = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, size, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            self.pop(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (value, size, expires_at)
+        self.size += size
+        while self.size > self.max_size or (self.max_entries is not None and len(self._data) > self.max_entries):
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
@@ -0,0 +1,180 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from typing import Dict, List, Optional
+
+import aiohttp
+
+GATEWAY_BOT_URL = 'https://discord.com/api/v10/gateway/bot'
+
+
+async def recommended_shard_count(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_BOT_URL, headers={'Authorization': f'Bot {token}'}) as r:
+            r.raise_for_status()
+            return (await r.json())['shards']
+
+
+def shard_ranges(shard_count: int, clusters: int) -> List[List[int]]:
+    """Split ``range(shard_count)`` into ``clusters`` contiguous, near-equal ranges."""
+    clusters = min(clusters, shard_count)
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def run_cluster(cluster_id: int, token: str, cogs: List[str], prefix: str, shard_ids: List[int], shard_count: int,
+                health: multiprocessing.Queue, heartbeat_interval: float):
+    """Entry point of a worker process: run one ``Bot`` for ``shard_ids``."""
+    from .bot import Bot
+
+    # Every cluster serves its own metrics, on consecutive ports.
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(int(metrics_port) + cluster_id)
+
+    bot = Bot(token, cogs, prefix, shard_ids=shard_ids, shard_count=shard_count)
+
+    async def heartbeat():
+        while True:
+            health.put({
+                'cluster': cluster_id,
+                'pid': os.getpid(),
+                'ready': bot.is_ready(),
+                'guilds': len(bot.guilds),
+                'latencies': {shard_id: latency for shard_id, latency in bot.latencies},
+            })
+            await asyncio.sleep(heartbeat_interval)
+
+    bot.loop.create_task(heartbeat())
+    bot.run()
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: List[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[multiprocessing.Process] = None
+        self.last_seen = 0.0
+        self.last_health: Optional[dict] = None
+        self.restarts = 0
+        self.restart_at = 0.0
+
+
+class ClusterLauncher:
+    """Runs the bot as several processes, each owning a contiguous range of shards.
+
+    Workers report health over a queue every ``heartbeat_interval`` seconds.
+    A worker that exits, or stays silent for ``heartbeat_timeout`` seconds, is
+    restarted with exponential backoff. A summary of every cluster is printed
+    every ``report_interval`` seconds.
+    """
+
+    def __init__(self, token: str, cogs: List[str], prefix: str, clusters: int, shard_count: Optional[int] = None,
+                 heartbeat_interval: float = 10, heartbeat_timeout: float = 120, report_interval: float = 60):
+        self.token = token
+        self.cogs = cogs
+        self.prefix = prefix
+        self.clusters = clusters
+        self.shard_count = shard_count
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.report_interval = report_interval
+        self.context = multiprocessing.get_context('spawn')
+        self.health = self.context.Queue()
+        self.workers: Dict[int, Worker] = {}
+
+    def start_worker(self, worker: Worker):
+        worker.process = self.context.Process(
+            target=run_cluster,
+            args=(worker.cluster_id, self.token, self.cogs, self.prefix, worker.shard_ids, self.shard_count,
+                  self.health, self.heartbeat_interval),
+            name=f'cluster-{worker.cluster_id}',
+            # Not daemonic: daemonic processes cannot start children, such as the
+            # TeX renderer's pool. run() terminates and joins workers on the way out.
+            daemon=False,
+        )
+        worker.process.start()
+        worker.last_seen = time.monotonic()
+        worker.last_health = None
+        print(f'Started cluster {worker.cluster_id} (shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}, '
+              f'pid {worker.process.pid})')
+
+    def schedule_restart(self, worker: Worker, reason: str):
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+        worker.process = None
+        backoff = min(60, 2 ** worker.restarts)
+        worker.restarts += 1
+        worker.restart_at = time.monotonic() + backoff
+        print(f'Cluster {worker.cluster_id} {reason}; restarting in {backoff}s')
+
+    def drain_health(self):
+        while True:
+            try:
+                report = self.health.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers.get(report['cluster'])
+            if worker is not None and worker.process is not None and report['pid'] == worker.process.pid:
+                worker.last_health = report
+                worker.last_seen = time.monotonic()
+                if report['ready']:
+                    worker.restarts = 0
+
+    def check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    self.start_worker(worker)
+            elif not worker.process.is_alive():
+                self.schedule_restart(worker, f'exited with code {worker.process.exitcode}')
+            elif now - worker.last_seen > self.heartbeat_timeout:
+                self.schedule_restart(worker, 'stopped reporting')
+
+    def report(self):
+        for worker in self.workers.values():
+            health = worker.last_health
+            if worker.process is None or health is None:
+                state = 'down' if worker.process is None else 'starting'
+                print(f'Cluster {worker.cluster_id}: {state}')
+                continue
+            latencies = ', '.join(f'{shard_id}: {latency * 1000:.0f}ms' for shard_id, latency in health['latencies'].items())
+            print(f'Cluster {worker.cluster_id}: {"ready" if health["ready"] else "connecting"}, '
+                  f'{health["guilds"]} guilds, latency {latencies or "-"}')
+
+    def run(self):
+        if self.shard_count is None:
+            self.shard_count = asyncio.run(recommended_shard_count(self.token))
+        for cluster_id, shard_ids in enumerate(shard_ranges(self.shard_count, self.clusters)):
+            self.workers[cluster_id] = Worker(cluster_id, shard_ids)
+        print(f'Launching {len(self.workers)} clusters for {self.shard_count} shards')
+        next_report = time.monotonic() + self.report_interval
+        try:
+            while True:
+                self.drain_health()
+                self.check_workers()
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report = time.monotonic() + self.report_interval
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print('Shutdown')
+        except Exception:
+            traceback.print_exc()
+        finally:
+            for worker in self.workers.values():
+                if worker.process is not None and worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers.values():
+                if worker.process is not None:
+                    worker.process.join(timeout=10)
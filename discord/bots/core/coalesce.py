@@ -0,0 +1,93 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class Coalescer:
+    """Share one in-flight call between concurrent callers with the same key.
+
+    The first caller for a key starts ``factory()``; callers arriving while it
+    is still running await the same task. Results are not kept once the task
+    finishes, so callers must not mutate what they get back.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        # A cancelled caller must not cancel the call for everyone else.
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+
+class _Broadcast:
+    """The items of one shared stream so far: only the latest is kept."""
+
+    def __init__(self):
+        self.latest = None
+        self.version = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, item):
+        self.latest = item
+        self.version += 1
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class StreamCoalescer:
+    """Share one in-flight async iterator between concurrent callers with the same key.
+
+    Items are meant to be snapshots: a caller joining late starts from the
+    latest item, and a slow caller skips to the latest instead of queueing
+    every item. Every caller sees the last item. The stream runs to the end
+    even if all callers stop listening.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, _Broadcast] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def stream(self, key: Hashable, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        shared = self._in_flight.get(key)
+        if shared is None:
+            shared = _Broadcast()
+            shared.task = asyncio.ensure_future(self._pump(shared, factory))
+            self._in_flight[key] = shared
+            shared.task.add_done_callback(lambda _: self._forget(key, shared))
+        seen = 0
+        while True:
+            changed = shared.changed
+            if shared.version > seen:
+                seen = shared.version
+                yield shared.latest
+            elif shared.task.done():
+                break
+            else:
+                await changed.wait()
+        shared.task.result()
+
+    @staticmethod
+    async def _pump(shared: _Broadcast, factory: Callable[[], AsyncIterator[T]]):
+        async for item in factory():
+            shared.publish(item)
+
+    def _forget(self, key: Hashable, shared: _Broadcast):
+        shared.changed.set()
+        if self._in_flight.get(key) is shared:
+            del self._in_flight[key]
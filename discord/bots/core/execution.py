@@ -0,0 +1,450 @@
+import asyncio
+import codecs
+import json
+import os
+import resource
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+# Result keys holding output text. Backends only ever append to them.
+OUTPUT_KEYS = ('compiler_output', 'compiler_error', 'program_output', 'program_error')
+
+
+class ExecutionBackend:
+    """Something that can run code and answer with a Wandbox-shaped result dict.
+
+    ``run`` returns ``(status, result)``: an HTTP-like status code and, on
+    success, a dict with the ``compiler_*``, ``program_*``, ``status`` and
+    ``signal`` keys that ``result_embed`` turns into an embed. Output cut to bound
+    memory is reported under ``truncated``, as ``{key: (bytes, lines)}``.
+    """
+
+    async def languages(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        """Map of supported language names to the compiler name shown to users."""
+        raise NotImplementedError
+
+    async def run(
+        self, session: aiohttp.ClientSession, language: str, compiler: str, code: str, stdin: str
+    ) -> Tuple[int, Optional[dict]]:
+        raise NotImplementedError
+
+    async def stream(
+        self, session: aiohttp.ClientSession, language: str, compiler: str, code: str, stdin: str
+    ) -> AsyncIterator[Tuple[int, Optional[dict]]]:
+        """Yield ``(status, result)`` as output arrives; the last item is the final result.
+
+        Each ``result`` is a snapshot holding everything received so far. Backends
+        that cannot stream yield once, when the run has finished.
+        """
+        yield await self.run(session, language, compiler, code, stdin)
+
+
+class LocalLanguage(NamedTuple):
+    executable: str
+    source: str
+    compile: Optional[List[str]]
+    run: List[str]
+    limit_address_space: bool = True
+
+
+LOCAL_LANGUAGES = {
+    'python': LocalLanguage('python3', 'main.py', None, ['python3', 'main.py']),
+    'c': LocalLanguage('gcc', 'main.c', ['gcc', '-O2', '-o', 'main', 'main.c', '-lm'], ['./main']),
+    'c++': LocalLanguage('g++', 'main.cpp', ['g++', '-O2', '-o', 'main', 'main.cpp'], ['./main']),
+    # V8 reserves far more address space than it uses, so RLIMIT_AS would kill it on
+    # start; RLIMIT_DATA still caps its heap and buffers.
+    'javascript': LocalLanguage(
+        'node', 'main.js', None, ['node', '--max-old-space-size=192', 'main.js'], limit_address_space=False
+    ),
+    'bashscript': LocalLanguage('bash', 'main.sh', None, ['bash', 'main.sh']),
+}
+
+
+# Run by ``sh -c`` as root in fresh mount, pid, network, IPC and UTS namespaces, with
+# arguments: sandbox root, work directory, uid, gid, command. Builds a root holding only
+# /usr (and its symlinks), a few device nodes, /proc of the new pid namespace, a /tmp and
+# the work directory at /sandbox, then runs the command there as ``uid:gid`` without
+# capabilities. The network namespace has no interfaces but a downed loopback.
+SANDBOX_SCRIPT = r'''
+set -eu
+root=$1 work=$2 uid=$3 gid=$4
+shift 4
+mount -t tmpfs -o size=64m,mode=755 sandbox "$root"
+mkdir -p "$root/etc" "$root/dev" "$root/proc" "$root/sandbox"
+mkdir -m 1777 "$root/tmp"
+for dir in /usr /bin /sbin /lib /lib32 /lib64 /libx32 /etc/alternatives; do
+    if [ -L "$dir" ]; then
+        ln -s "$(readlink "$dir")" "$root$dir"
+    elif [ -d "$dir" ]; then
+        mkdir -p "$root$dir"
+        mount --rbind "$dir" "$root$dir"
+        mount -o remount,bind,ro "$root$dir"
+    fi
+done
+for file in /etc/ld.so.cache /dev/null /dev/zero /dev/random /dev/urandom; do
+    if [ -e "$file" ]; then
+        touch "$root$file"
+        mount --bind "$file" "$root$file"
+    fi
+done
+mount -t proc proc "$root/proc"
+mount --bind "$work" "$root/sandbox"
+exec chroot "$root" setpriv --reuid="$uid" --regid="$gid" --clear-groups \
+    --no-new-privs --inh-caps=-all --bounding-set=-all \
+    env -i -C /sandbox PATH=/usr/local/bin:/usr/bin:/bin HOME=/sandbox LANG=C.UTF-8 "$@"
+'''
+SANDBOX_NAMESPACES = ['--mount', '--pid', '--net', '--ipc', '--uts', '--fork', '--kill-child']
+
+
+async def sandbox_unavailable() -> Optional[str]:
+    """Why ``LocalBackend`` cannot isolate programs on this host, or ``None`` if it can."""
+    if os.geteuid() != 0:
+        return 'not running as root'
+    missing = [tool for tool in ('unshare', 'chroot', 'setpriv') if shutil.which(tool) is None]
+    if missing:
+        return f'{", ".join(missing)} not found'
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'unshare', *SANDBOX_NAMESPACES, 'true',
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return 'unshare cannot be started'
+    try:
+        returncode = await asyncio.wait_for(process.wait(), 10)
+    except asyncio.TimeoutError:
+        process.kill()
+        returncode = None
+    if returncode != 0:
+        return 'namespaces cannot be created (the container needs CAP_SYS_ADMIN)'
+    return None
+
+
+class LocalBackend(ExecutionBackend):
+    """Runs code in sandboxed subprocesses on this host, at most ``max_workers`` at a time.
+
+    Each program runs as the unprivileged ``uid:gid`` in its own namespaces
+    (see ``SANDBOX_SCRIPT``): it sees only /usr and a fresh work directory, has
+    no network and cannot see or signal other processes. CPU time, memory,
+    file size and process count are limited by rlimits, and there is a
+    wall-clock timeout and a cap on captured output. ``RLIMIT_NPROC`` counts
+    all processes of ``uid``, so ``max_processes`` is shared by concurrent runs.
+    The defaults keep ``max_workers`` runs, with their tmpfs roots, within
+    the runner container's memory limit in ``compose.yaml``.
+
+    Needs root and namespace support, checked on the first call to
+    ``languages``; without them no language is available.
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[List[str]] = None,
+        max_workers: int = 2,
+        time_limit: int = 10,
+        memory_limit: int = 256 * 1024 * 1024,
+        output_limit: int = 1024 * 1024,
+        max_processes: int = 64,
+        uid: int = 65534,
+        gid: int = 65534,
+    ):
+        self.languages_available = {
+            name: language
+            for name, language in LOCAL_LANGUAGES.items()
+            if (enabled is None or name in enabled) and shutil.which(language.executable)
+        }
+        self._sandbox_checked: Optional[asyncio.Future] = None
+        self.slots = asyncio.Semaphore(max_workers)
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.output_limit = output_limit
+        self.max_processes = max_processes
+        self.uid = uid
+        self.gid = gid
+
+    async def languages(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        if self.languages_available:
+            if self._sandbox_checked is None:
+                self._sandbox_checked = asyncio.ensure_future(self._check_sandbox())
+            await asyncio.shield(self._sandbox_checked)
+        return {name: f'local-{language.executable}' for name, language in self.languages_available.items()}
+
+    async def _check_sandbox(self):
+        reason = await sandbox_unavailable()
+        if reason is not None:
+            print(f'Local execution disabled: {reason}')
+            self.languages_available = {}
+
+    def _limit(self, limit_address_space: bool):
+        os.setsid()
+        resource.setrlimit(resource.RLIMIT_CPU, (self.time_limit, self.time_limit + 1))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (self.output_limit, self.output_limit))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        # Only enforced once the sandbox drops to self.uid; root ignores it.
+        resource.setrlimit(resource.RLIMIT_NPROC, (self.max_processes, self.max_processes))
+        resource.setrlimit(resource.RLIMIT_DATA, (self.memory_limit, self.memory_limit))
+        if limit_address_space:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+
+    @staticmethod
+    def _kill(process: asyncio.subprocess.Process):
+        # The sandboxed program may have left our process group, but killing
+        # unshare kills the init of its pid namespace, and with it everything inside.
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    async def _read(self, stream: asyncio.StreamReader, result: dict, key: str, changed: asyncio.Event):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        size = dropped = dropped_lines = 0
+        # Keep draining past the limit so the child never blocks on a full pipe.
+        while data := await stream.read(65536):
+            if size + len(data) > self.output_limit:
+                dropped += size + len(data) - self.output_limit
+                dropped_lines += data[max(0, self.output_limit - size):].count(b'\n')
+                result['truncated'] = {**result.get('truncated', {}), key: (dropped, dropped_lines)}
+            if size >= self.output_limit:
+                continue
+            data = data[:self.output_limit - size]
+            size += len(data)
+            result[key] += decoder.decode(data)
+            changed.set()
+        result[key] += decoder.decode(b'', final=True)
+
+    async def _exec(
+        self, args: List[str], root: str, work: str, stdin: str, limit_address_space: bool,
+        result: dict, prefix: str, changed: asyncio.Event,
+    ) -> Tuple[int, str]:
+        """Run ``args`` in the sandbox, appending its output to ``result[prefix + '_output' / '_error']``."""
+        process = await asyncio.create_subprocess_exec(
+            'unshare', *SANDBOX_NAMESPACES,
+            'sh', '-c', SANDBOX_SCRIPT, 'sandbox', root, work, str(self.uid), str(self.gid), *args,
+            cwd=work,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={'PATH': os.environ.get('PATH', '/usr/bin:/bin'), 'LANG': 'C.UTF-8'},
+            preexec_fn=lambda: self._limit(limit_address_space),
+        )
+
+        async def communicate():
+            process.stdin.write(stdin.encode())
+            try:
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            process.stdin.close()
+            await asyncio.gather(
+                self._read(process.stdout, result, f'{prefix}_output', changed),
+                self._read(process.stderr, result, f'{prefix}_error', changed),
+            )
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), self.time_limit)
+        except asyncio.TimeoutError:
+            self._kill(process)
+            await process.wait()
+            error_key = f'{prefix}_error'
+            result[error_key] += ('\n' if result[error_key] else '') + 'Time limit exceeded'
+            changed.set()
+            return process.returncode, 'SIGKILL'
+        except asyncio.CancelledError:
+            self._kill(process)
+            raise
+        sig = signal.Signals(-returncode).name if returncode < 0 else ''
+        return returncode, sig
+
+    async def _execute(self, spec: LocalLanguage, code: str, stdin: str, result: dict, changed: asyncio.Event):
+        async with self.slots:
+            with tempfile.TemporaryDirectory(prefix='run-') as tmp:
+                root, work = os.path.join(tmp, 'root'), os.path.join(tmp, 'work')
+                os.mkdir(root)
+                os.mkdir(work)
+                with open(os.path.join(work, spec.source), 'w') as f:
+                    f.write(code)
+                os.chown(work, self.uid, self.gid)
+                os.chown(os.path.join(work, spec.source), self.uid, self.gid)
+                if spec.compile:
+                    returncode, sig = await self._exec(
+                        spec.compile, root, work, '', spec.limit_address_space, result, 'compiler', changed
+                    )
+                    if returncode != 0:
+                        result.update(status=str(returncode), signal=sig)
+                        return
+                returncode, sig = await self._exec(
+                    spec.run, root, work, stdin, spec.limit_address_space, result, 'program', changed
+                )
+        result.update(status=str(returncode), signal=sig)
+
+    async def stream(
+        self, session: aiohttp.ClientSession, language: str, compiler: str, code: str, stdin: str
+    ) -> AsyncIterator[Tuple[int, Optional[dict]]]:
+        spec = self.languages_available[language]
+        result = dict.fromkeys(OUTPUT_KEYS, '')
+        changed = asyncio.Event()
+        task = asyncio.ensure_future(self._execute(spec, code, stdin, result, changed))
+        try:
+            while True:
+                waiter = asyncio.ensure_future(changed.wait())
+                await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if task.done():
+                    break
+                changed.clear()
+                yield 200, dict(result)
+            await task
+        finally:
+            # The consumer gave up early: stop the process rather than let it run on unobserved.
+            task.cancel()
+        yield 200, result
+
+    async def run(
+        self, session: aiohttp.ClientSession, language: str, compiler: str, code: str, stdin: str
+    ) -> Tuple[int, Optional[dict]]:
+        async for status, result in self.stream(session, language, compiler, code, stdin):
+            pass
+        return status, result
+
+
+class RunnerServer:
+    """Serves ``backend`` over HTTP to ``RemoteBackend``, so only the runner needs the sandbox's privileges.
+
+    ``GET /languages`` answers ``backend.languages`` as JSON. ``POST /run`` takes
+    ``language``, ``code`` and ``stdin`` as JSON and streams NDJSON, one
+    ``{"status": ..., "result": ...}`` line per item of ``backend.stream``,
+    where ``result`` holds only the text appended to each of ``OUTPUT_KEYS``
+    since the line before.
+    """
+
+    def __init__(self, backend: ExecutionBackend, host: str, port: int):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle_languages(self, request: web.Request) -> web.Response:
+        return web.json_response(await self.backend.languages(None))
+
+    async def handle_run(self, request: web.Request) -> web.StreamResponse:
+        try:
+            params = await request.json()
+            language, code, stdin = params['language'], params['code'], params.get('stdin', '')
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest()
+        languages = await self.backend.languages(None)
+        if language not in languages:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        sent = dict.fromkeys(OUTPUT_KEYS, 0)
+        # Closing the stream early, when the client has gone away, stops the run.
+        async with aclosing(self.backend.stream(None, language, languages[language], code, stdin)) as items:
+            async for status, result in items:
+                if result is not None:
+                    result = dict(result)
+                    for key in OUTPUT_KEYS:
+                        if key in result:
+                            result[key], sent[key] = result[key][sent[key]:], len(result[key])
+                try:
+                    await response.write(json.dumps({'status': status, 'result': result}).encode() + b'\n')
+                except ConnectionResetError:
+                    return response
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/languages', self.handle_languages)
+        app.router.add_post('/run', self.handle_run)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class RemoteBackend(ExecutionBackend):
+    """Runs code on the ``RunnerServer`` at ``url``, listing its languages at most every ``ttl`` seconds."""
+
+    # Runs stream for as long as the program does, so only silence is a timeout.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+
+    def __init__(self, url: str, ttl: float = 60):
+        self.url = url.rstrip('/')
+        self.ttl = ttl
+        self._languages: Dict[str, str] = {}
+        self._listed_at = float('-inf')
+
+    async def languages(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        if time.monotonic() - self._listed_at > self.ttl:
+            self._listed_at = time.monotonic()
+            languages = {}
+            try:
+                async with session.get(self.url + '/languages', timeout=aiohttp.ClientTimeout(total=5)) as r:
+                    if r.status == 200:
+                        languages = await r.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                traceback.print_exc()
+            # While the runner is unreachable its languages go to the router's fallback.
+            self._languages = languages
+        return self._languages
+
+    async def stream(
+        self, session: aiohttp.ClientSession, language: str, compiler: str, code: str, stdin: str
+    ) -> AsyncIterator[Tuple[int, Optional[dict]]]:
+        params = {'language': language, 'code': code, 'stdin': stdin}
+        async with session.post(self.url + '/run', json=params, timeout=self.timeout) as r:
+            if r.status != 200:
+                yield r.status, None
+                return
+            result = dict.fromkeys(OUTPUT_KEYS, '')
+            buffer = b''
+            async for chunk in r.content.iter_any():
+                *lines, buffer = (buffer + chunk).split(b'\n')
+                for line in lines:
+                    item = json.loads(line)
+                    if item['result'] is None:
+                        yield item['status'], None
+                        return
+                    for key, value in item['result'].items():
+                        result[key] = result[key] + value if key in OUTPUT_KEYS else value
+                    yield item['status'], dict(result)
+
+
+class ExecutionRouter:
+    """Picks a backend per language: ``routes`` first, then ``fallback``."""
+
+    def __init__(self, fallback: ExecutionBackend, routes: Optional[Dict[str, ExecutionBackend]] = None):
+        self.fallback = fallback
+        self.routes = routes or {}
+        # Routed languages their backend offered at the last call to ``languages``.
+        self.offered: Dict[str, ExecutionBackend] = {}
+
+    async def languages(self, session: aiohttp.ClientSession) -> Dict[str, str]:
+        languages = dict(await self.fallback.languages(session))
+        offered = {}
+        for language, backend in self.routes.items():
+            compilers = await backend.languages(session)
+            if language in compilers:
+                languages[language] = compilers[language]
+                offered[language] = backend
+        self.offered = offered
+        return languages
+
+    def backend_for(self, language: str) -> ExecutionBackend:
+        """The backend for ``language``, as of the last call to ``languages``."""
+        return self.offered.get(language, self.fallback)
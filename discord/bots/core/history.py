@@ -0,0 +1,132 @@
+from collections import deque
+from typing import Deque, Iterable, List, NamedTuple, Optional
+
+import discord
+
+from .cache import LRUCache
+
+
+class Entry(NamedTuple):
+    message_id: int
+    author_id: int
+    content: str
+
+    @property
+    def size(self) -> int:
+        return len(self.content.encode('utf-8'))
+
+
+def approximate_tokens(text: str) -> int:
+    """About one token per three UTF-8 bytes: close for Japanese, generous for English."""
+    return len(text.encode('utf-8')) // 3 + 1
+
+
+class ChannelBuffer:
+    """The latest ``size_limit`` messages of one channel, oldest first."""
+
+    def __init__(self, size_limit: int):
+        self.entries: Deque[Entry] = deque(maxlen=size_limit)
+        # UTF-8 bytes of content held.
+        self.size = 0
+        # Whether the messages before the first entry were loaded too, so the
+        # buffer holds everything recent rather than just what arrived since startup.
+        self.seeded = False
+
+    def _index(self, message_id: int) -> Optional[int]:
+        for i in range(len(self.entries) - 1, -1, -1):
+            if self.entries[i].message_id == message_id:
+                return i
+        return None
+
+    def add(self, entry: Entry):
+        if self._index(entry.message_id) is not None:
+            return
+        if len(self.entries) == self.entries.maxlen:
+            self.size -= self.entries[0].size
+        self.entries.append(entry)
+        self.size += entry.size
+
+    def edit(self, message_id: int, content: str) -> bool:
+        i = self._index(message_id)
+        if i is None:
+            return False
+        self.size -= self.entries[i].size
+        self.entries[i] = self.entries[i]._replace(content=content)
+        self.size += self.entries[i].size
+        return True
+
+    def delete(self, message_ids: Iterable[int]) -> bool:
+        message_ids = set(message_ids)
+        kept = [entry for entry in self.entries if entry.message_id not in message_ids]
+        if len(kept) == len(self.entries):
+            return False
+        self.entries = deque(kept, maxlen=self.entries.maxlen)
+        self.size = sum(entry.size for entry in kept)
+        return True
+
+
+class ChannelHistory:
+    """Recent messages per channel, fed by gateway events, for building chat context without REST calls.
+
+    At most ``max_channels`` channels and ``max_bytes`` bytes of content
+    are kept, least recently active channels first out; a channel nobody has
+    written in for ``idle_ttl`` seconds is dropped.
+    """
+
+    def __init__(self, max_channels: int = 1000, max_bytes: int = 8 * 1024 * 1024,
+                 messages_per_channel: int = 50, idle_ttl: float = 60 * 60):
+        self.messages_per_channel = messages_per_channel
+        self.idle_ttl = idle_ttl
+        self._channels = LRUCache(max_bytes, sizeof=lambda buffer: buffer.size, max_entries=max_channels)
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def _store(self, channel_id: int, buffer: ChannelBuffer):
+        # Storing again re-measures the buffer and restarts its idle timer.
+        self._channels.set(channel_id, buffer, ttl=self.idle_ttl)
+
+    def get(self, channel_id: int) -> Optional[ChannelBuffer]:
+        return self._channels.get(channel_id)
+
+    def add(self, message: discord.Message):
+        buffer = self.get(message.channel.id) or ChannelBuffer(self.messages_per_channel)
+        buffer.add(Entry(message.id, message.author.id, message.content))
+        self._store(message.channel.id, buffer)
+
+    def seed(self, channel_id: int, messages: List[discord.Message]):
+        """Fill the channel's buffer with ``messages`` (oldest first) fetched over REST."""
+        buffer = ChannelBuffer(self.messages_per_channel)
+        for message in messages:
+            buffer.add(Entry(message.id, message.author.id, message.content))
+        current = self.get(channel_id)
+        if current is not None:
+            # Keep what arrived while the fetch was in flight.
+            for entry in current.entries:
+                buffer.add(entry)
+        buffer.seeded = True
+        self._store(channel_id, buffer)
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        buffer = self.get(channel_id)
+        if buffer is not None and buffer.edit(message_id, content):
+            self._store(channel_id, buffer)
+
+    def delete(self, channel_id: int, message_ids: Iterable[int]):
+        buffer = self.get(channel_id)
+        if buffer is not None and buffer.delete(message_ids):
+            self._store(channel_id, buffer)
+
+    def context(self, channel_id: int, token_budget: int) -> List[Entry]:
+        """The latest entries, oldest first, that fit in ``token_budget``. Always includes the latest."""
+        buffer = self.get(channel_id)
+        if buffer is None:
+            return []
+        selected = []
+        for entry in reversed(buffer.entries):
+            token_budget -= approximate_tokens(entry.content)
+            if token_budget < 0 and selected:
+                break
+            selected.append(entry)
+        selected.reverse()
+        return selected
@@ -0,0 +1,72 @@
+import os
+from typing import AsyncIterator, Optional
+
+from .metrics import backend_responses
+
+
+def metered_transport(backend: str, **kwargs):
+    """An httpx transport recording the status, or exception, of every request in ``backend_responses``.
+
+    The counterpart of ``http_trace_config`` for clients built on httpx. ``kwargs``
+    are those of ``httpx.AsyncHTTPTransport``; a client given a transport ignores
+    its own ``limits``, so they must be passed here.
+    """
+    import httpx
+
+    class MeteredTransport(httpx.AsyncHTTPTransport):
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            try:
+                response = await super().handle_async_request(request)
+            except Exception as e:
+                backend_responses.inc(backend=backend, status=type(e).__name__)
+                raise
+            backend_responses.inc(backend=backend, status=response.status_code)
+            return response
+
+    return MeteredTransport(**kwargs)
+
+
+class OpenAIClient:
+    """``AsyncOpenAI`` client shared by all cogs, imported and built on first use.
+
+    Importing ``openai`` takes most of a second, so it is kept off the startup path.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(
+                api_key=self.api_key or os.getenv('OPENAI_API_KEY'),
+                base_url=self.base_url,
+                http_client=httpx.AsyncClient(
+                    # The connection limits of the SDK's own client; httpx defaults to 100 and 20.
+                    transport=metered_transport(
+                        'openai', limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+                    ),
+                    follow_redirects=True,
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+
+
+async def stream_chat(client, **kwargs) -> AsyncIterator[str]:
+    """Yield the reply so far each time ``chat.completions`` streams more of it."""
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    text = ''
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            yield text
@@ -0,0 +1,97 @@
+import asyncio
+import importlib.util
+import io
+import multiprocessing
+import multiprocessing.pool
+import threading
+from typing import Optional, Set, Tuple
+
+
+def render_png(code: str, dpi: int) -> bytes:
+    """Render ``code`` in math mode with matplotlib's mathtext. Runs in a worker process."""
+    from matplotlib import mathtext
+
+    output = io.BytesIO()
+    mathtext.math_to_image(f'${code}$', output, dpi=dpi, format='png')
+    return output.getvalue()
+
+
+class LocalRenderer:
+    """In-process fallback for the tex service, covering the subset of LaTeX mathtext supports.
+
+    Rendering happens in a pool of ``workers`` processes, started on first use
+    so matplotlib is never loaded into the bot process. A render that takes
+    longer than ``timeout`` seconds gets the pool killed and replaced, so a
+    stuck formula cannot hold a worker; one whose caller gives up first is
+    left to finish and its result dropped. Unavailable when matplotlib is
+    not installed.
+    """
+
+    def __init__(self, workers: int = 1, dpi: int = 200, timeout: float = 10):
+        self.workers = workers
+        self.dpi = dpi
+        self.timeout = timeout
+        self.available = importlib.util.find_spec('matplotlib') is not None
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+        # Renders submitted to the current pool and not finished yet.
+        self._pending: Set[asyncio.Future] = set()
+
+    @property
+    def pool(self) -> multiprocessing.pool.Pool:
+        if self._pool is None:
+            self._pool = multiprocessing.get_context('spawn').Pool(self.workers)
+        return self._pool
+
+    async def render(self, code: str) -> Tuple[Optional[bytes], Optional[str]]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(result=None, error=None):
+            # Called from the pool's result thread.
+            def apply():
+                if future.done():
+                    return
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            loop.call_soon_threadsafe(apply)
+
+        self.pool.apply_async(
+            render_png, (code, self.dpi),
+            callback=lambda result: settle(result=result),
+            error_callback=lambda error: settle(error=error),
+        )
+        self._pending.add(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout), None
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._pending.discard(future)
+                future.cancel()
+                self.recycle()
+            return None, 'Local renderer timed out'
+        except asyncio.CancelledError:
+            # The render finishes in its worker; settle() then finds it cancelled.
+            future.cancel()
+            raise
+        except Exception as e:
+            return None, str(e)
+        finally:
+            self._pending.discard(future)
+
+    def recycle(self):
+        """Kill the pool, failing renders still running in it; the next render starts a new one."""
+        pool, self._pool = self._pool, None
+        pending, self._pending = self._pending, set()
+        for future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError('Local renderer restarted'))
+        if pool is not None:
+            # terminate() joins the pool's threads; keep that off the event loop.
+            threading.Thread(target=pool.terminate, daemon=True).start()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+        self._pool = None
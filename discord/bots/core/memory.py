@@ -0,0 +1,83 @@
+import asyncio
+import os
+import resource
+from typing import Any, Callable, Dict, Optional
+
+import discord
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def low_memory_intents() -> discord.Intents:
+    """Only what the cogs use: guild and DM messages with their content.
+
+    ``guilds`` is kept because channels and permissions hang off it.
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    return intents
+
+
+def default_intents() -> discord.Intents:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    return intents
+
+
+def client_options(profile: str) -> Dict[str, Any]:
+    """Keyword arguments for the client for a memory ``profile`` (``default`` or ``low``).
+
+    The low profile caches no members beyond those in event payloads, skips
+    chunking, and keeps only the most recent messages. Command edits and
+    deletes are handled from raw events, so they do not depend on the cache.
+    """
+    if profile == 'default':
+        return {'intents': default_intents()}
+    if profile == 'low':
+        return {
+            'intents': low_memory_intents(),
+            'member_cache_flags': discord.MemberCacheFlags.none(),
+            'chunk_guilds_at_startup': False,
+            'max_messages': 200,
+        }
+    raise ValueError(f'Unknown memory profile: {profile!r}')
+
+
+def resident_memory() -> int:
+    """Resident set size of this process in bytes (peak RSS where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryReporter:
+    """Prints resident memory, overall and per guild, every ``interval`` seconds."""
+
+    def __init__(self, guild_count: Callable[[], int], interval: float):
+        self.guild_count = guild_count
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def report(self) -> str:
+        rss = resident_memory()
+        guilds = self.guild_count()
+        per_guild = f'{rss / guilds / 1024:.1f} KiB/guild' if guilds else '- KiB/guild'
+        return f'Memory: {rss / 1024 / 1024:.1f} MiB resident, {guilds} guilds, {per_guild}'
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            print(self.report())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
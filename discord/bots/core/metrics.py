@@ -0,0 +1,234 @@
+import asyncio
+import math
+import time
+import traceback
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def label_set(**labels) -> Labels:
+    """Hashable form of a set of labels, as used for keys of callback results."""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Sampled(Metric):
+    """Values that are set directly, or read from ``callback`` at scrape time.
+
+    ``callback`` returns a number, or a dict mapping ``label_set(...)`` to numbers.
+    """
+
+    def __init__(self, name: str, help: str, callback: Optional[Callable[[], Union[float, Dict[Labels, float]]]] = None):
+        super().__init__(name, help)
+        self.callback = callback
+        self.values: Dict[Labels, float] = {}
+
+    def samples(self):
+        values = self.values
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception:
+                traceback.print_exc()
+                return
+            values = result if isinstance(result, dict) else {(): result}
+        for labels, value in values.items():
+            if value is not None and not math.isnan(value):
+                yield self.name, labels, value
+
+
+class Counter(Sampled):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_set(**labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Sampled):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[label_set(**labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = sorted(buckets) + [math.inf]
+        # labels -> (per-bucket counts, sum, count)
+        self.values: Dict[Labels, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = label_set(**labels)
+        counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels + (('le', _format_value(bound)),), cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, callback=None) -> Counter:
+        return self._register(Counter(name, help, callback))
+
+    def gauge(self, name: str, help: str, callback=None) -> Gauge:
+        return self._register(Gauge(name, help, callback))
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by the bot and every module that reports to it.
+registry = Registry()
+
+backend_request_seconds = registry.histogram(
+    'backend_request_seconds', 'Time spent in backend calls, excluding time queued.',
+)
+backend_responses = registry.counter(
+    'backend_responses_total', 'Backend call outcomes, by HTTP status or exception type.',
+)
+
+# Hostnames of the HTTP backends called through the shared aiohttp session.
+BACKEND_HOSTS = {
+    'wandbox.org': 'wandbox',
+    'tex': 'tex',
+    'api.wolframalpha.com': 'wolfram',
+}
+
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    """Record status codes of requests to ``BACKEND_HOSTS`` made through a session."""
+    trace_config = aiohttp.TraceConfig()
+
+    def backend(url) -> str:
+        return BACKEND_HOSTS.get(urlsplit(str(url)).hostname, 'other')
+
+    async def on_request_end(session, context, params):
+        backend_responses.inc(backend=backend(params.url), status=params.response.status)
+
+    async def on_request_exception(session, context, params):
+        backend_responses.inc(backend=backend(params.url), status=type(params.exception).__name__)
+
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task that sleeps for ``interval``."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.perf_counter() - started - self.interval)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+class MetricsServer:
+    """Serves ``registry`` at ``/metrics`` on a small aiohttp server."""
+
+    def __init__(self, registry: Registry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,142 @@
+import contextlib
+import fcntl
+import os
+import pathlib
+import time
+from typing import Iterator, Optional, Set, Tuple
+
+
+class OptOutRegistry:
+    """In-memory set of opted-out user ids backed by a snapshot file and an append-only log.
+
+    The snapshot keeps the historical ``opt-out-users.txt`` format (one id per line).
+    Changes are appended to ``<snapshot>.log`` as ``+id`` / ``-id`` lines and folded
+    back into the snapshot once the log grows past ``compact_threshold`` entries.
+    External edits to either file are picked up by comparing file stats, at most once
+    every ``check_interval`` seconds.
+
+    Several processes may share the files: every change takes an exclusive
+    ``flock`` on ``<snapshot>.lock`` and reloads both files first, so it
+    never hides or overwrites another process's changes; reads take a shared one.
+    """
+
+    def __init__(self, path: pathlib.Path, compact_threshold: int = 100, check_interval: float = 5.0):
+        self.path = pathlib.Path(path)
+        self.log_path = self.path.with_name(self.path.name + '.log')
+        self.lock_path = self.path.with_name(self.path.name + '.lock')
+        self.compact_threshold = compact_threshold
+        self.check_interval = check_interval
+        self._users: Set[int] = set()
+        self._log_entries = 0
+        self._stats = (None, None)
+        self._last_check = 0.0
+        self.load()
+
+    def __contains__(self, user_id: int) -> bool:
+        self._maybe_reload()
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    @staticmethod
+    def _stat(path: pathlib.Path) -> Optional[Tuple[int, int, int]]:
+        # The size and inode catch appends and replacements within one mtime tick.
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _current_stats(self):
+        return self._stat(self.path), self._stat(self.log_path)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self._current_stats() != self._stats:
+            self.load()
+
+    def load(self):
+        with self._locked(exclusive=False):
+            self._load()
+
+    def _load(self):
+        users = set()
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        users.add(int(line))
+        entries = 0
+        if self.log_path.exists():
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    entries += 1
+                    if line[0] == '-':
+                        users.discard(int(line[1:]))
+                    else:
+                        users.add(int(line.lstrip('+')))
+        self._users = users
+        self._log_entries = entries
+        self._stats = self._current_stats()
+        self._last_check = time.monotonic()
+
+    def _change(self, op: str, user_id: int) -> bool:
+        with self._locked(exclusive=True):
+            self._load()
+            if (user_id in self._users) == (op == '+'):
+                return False
+            with open(self.log_path, 'a') as f:
+                f.write(f'{op}{user_id}\n')
+            if op == '+':
+                self._users.add(user_id)
+            else:
+                self._users.discard(user_id)
+            self._log_entries += 1
+            if self._log_entries >= self.compact_threshold:
+                self._compact()
+            else:
+                # Nobody else can have written since the reload above.
+                self._stats = self._current_stats()
+        return True
+
+    def add(self, user_id: int) -> bool:
+        """Opt a user out. Returns ``False`` if they already were."""
+        return self._change('+', user_id)
+
+    def remove(self, user_id: int) -> bool:
+        """Opt a user back in. Returns ``False`` if they were not opted out."""
+        return self._change('-', user_id)
+
+    def compact(self):
+        """Fold the log into the snapshot and remove it."""
+        with self._locked(exclusive=True):
+            self._load()
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            for user_id in sorted(self._users):
+                f.write(f'{user_id}\n')
+        os.replace(tmp_path, self.path)
+        if self.log_path.exists():
+            os.remove(self.log_path)
+        self._log_entries = 0
+        self._stats = self._current_stats()
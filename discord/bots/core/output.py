@@ -0,0 +1,68 @@
+import gzip
+import io
+from typing import Dict, Tuple
+
+# Kept per output field, in characters; the rest is only counted.
+OUTPUT_LIMIT = 1024 * 1024
+# Attachments larger than this are gzipped.
+COMPRESS_THRESHOLD = 256 * 1024
+
+Truncation = Dict[str, Tuple[int, int]]
+
+
+class CappedText:
+    """Text appended piece by piece, keeping the first ``limit`` characters.
+
+    What does not fit is counted, in UTF-8 bytes and lines, but not stored.
+    """
+
+    def __init__(self, limit: int = OUTPUT_LIMIT):
+        self.limit = limit
+        self.kept = 0
+        self.dropped_bytes = 0
+        self.dropped_lines = 0
+        self._text = ''
+        self._parts = []
+
+    def append(self, text: str):
+        room = self.limit - self.kept
+        if room > 0:
+            keep = text[:room]
+            self._parts.append(keep)
+            self.kept += len(keep)
+            text = text[room:]
+        if text:
+            self.dropped_bytes += len(text.encode('utf-8', 'replace'))
+            self.dropped_lines += text.count('\n')
+
+    def __str__(self) -> str:
+        if self._parts:
+            self._text += ''.join(self._parts)
+            self._parts = []
+        return self._text
+
+
+def line_count(text: str) -> int:
+    return text.count('\n') + 1
+
+
+def describe_truncation(truncated: Truncation) -> str:
+    """One line per field, e.g. ``program_output: 3.2 MiB (51,200 lines) cut``."""
+    lines = []
+    for key, (size, newlines) in truncated.items():
+        if size >= 1024 * 1024:
+            amount = f'{size / 1024 / 1024:.1f} MiB'
+        elif size >= 1024:
+            amount = f'{size / 1024:.1f} KiB'
+        else:
+            amount = f'{size} bytes'
+        lines.append(f'{key}: {amount} ({newlines:,} lines) cut')
+    return '\n'.join(lines)
+
+
+def attachment(text: str, name: str) -> Tuple[io.BytesIO, str]:
+    """``text`` as a file to upload, gzipped when larger than ``COMPRESS_THRESHOLD``."""
+    data = text.encode('utf-8')
+    if len(data) > COMPRESS_THRESHOLD:
+        return io.BytesIO(gzip.compress(data)), f'{name}.txt.gz'
+    return io.BytesIO(data), f'{name}.txt'
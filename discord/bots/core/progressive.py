@@ -0,0 +1,118 @@
+import asyncio
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import discord
+
+# Discord allows about five message edits per five seconds per channel.
+EDIT_INTERVAL = 1.5
+MESSAGE_LIMIT = 2000
+FIELD_LIMIT = 1024
+
+Page = Dict[str, Any]
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """Split ``text`` into pieces of at most ``limit`` characters, at newlines or spaces when possible.
+
+    Pieces only depend on the text before them, so the pieces of a prefix of
+    ``text`` stay the same as ``text`` grows, except the last.
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    pieces.append(text)
+    return pieces
+
+
+def _comparable(page: Page) -> Page:
+    return {key: value.to_dict() if isinstance(value, discord.Embed) else value for key, value in page.items()}
+
+
+class ProgressiveEdit:
+    """Edits ``message`` with the latest update at most once every ``interval`` seconds.
+
+    Updates arriving in between replace the pending one, so a fast producer
+    costs one edit per interval however often it updates.
+    """
+
+    def __init__(self, message: discord.Message, interval: float = EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.pending: Optional[Page] = None
+        self.last_edit = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, **fields):
+        self.pending = fields
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        await asyncio.sleep(max(0.0, self.last_edit + self.interval - time.monotonic()))
+        fields, self.pending = self.pending, None
+        self.last_edit = time.monotonic()
+        try:
+            await self.message.edit(**fields)
+        except discord.HTTPException:
+            traceback.print_exc()
+
+    def cancel(self):
+        """Drop the pending edit, if any."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def finish(self, **fields):
+        self.cancel()
+        await self.message.edit(**fields)
+
+
+class ProgressiveMessages:
+    """Shows a growing list of pages, one message each, sent with ``send(**page)``.
+
+    Every page but the last is final: it is sent, or edited a last time, as
+    soon as a later page appears. The last page is edited progressively.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[discord.Message]], interval: float = EDIT_INTERVAL):
+        self.send = send
+        self.interval = interval
+        self.replies: List[ProgressiveEdit] = []
+        # What each message shows, or will once its pending edit is made.
+        self.shown: List[Page] = []
+
+    async def _sync(self, pages: List[Page]) -> bool:
+        """Send or finalize every page but the last; whether the last was already shown."""
+        for i, page in enumerate(pages[:-1]):
+            if i < len(self.replies):
+                if self.shown[i] != _comparable(page):
+                    await self.replies[i].finish(**page)
+            else:
+                self.replies.append(ProgressiveEdit(await self.send(**page), self.interval))
+            self.shown[i:i + 1] = [_comparable(page)]
+        if len(self.replies) < len(pages):
+            self.replies.append(ProgressiveEdit(await self.send(**pages[-1]), self.interval))
+            self.shown.append(_comparable(pages[-1]))
+            return False
+        return True
+
+    async def update(self, pages: List[Page]):
+        if await self._sync(pages) and self.shown[-1] != _comparable(pages[-1]):
+            self.replies[-1].update(**pages[-1])
+            self.shown[-1] = _comparable(pages[-1])
+
+    async def finish(self, pages: List[Page]):
+        if await self._sync(pages):
+            await self.replies[-1].finish(**pages[-1])
+            self.shown[-1] = _comparable(pages[-1])
+
+    @property
+    def messages(self) -> List[discord.Message]:
+        return [reply.message for reply in self.replies]
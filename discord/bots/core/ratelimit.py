@@ -0,0 +1,123 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, NamedTuple, Optional
+
+from discord.ext import commands
+
+
+class RateLimit(NamedTuple):
+    """Allow bursts of ``capacity`` calls, refilled evenly over ``per`` seconds."""
+    capacity: int
+    per: float
+
+
+# Limits per command class, for each scope a caller is counted in.
+DEFAULT_LIMITS: Dict[str, Dict[str, RateLimit]] = {
+    'code': {'user': RateLimit(5, 60), 'guild': RateLimit(30, 60)},
+    'tex': {'user': RateLimit(10, 60), 'guild': RateLimit(60, 60)},
+    'wolfram': {'user': RateLimit(3, 60), 'guild': RateLimit(15, 60)},
+    'translate': {'user': RateLimit(5, 60), 'guild': RateLimit(20, 60)},
+    'mention': {'user': RateLimit(3, 60)},
+}
+
+# Qualified command name -> command class. Commands not listed are not limited.
+COMMAND_CLASSES = {
+    'run': 'code',
+    'tex': 'tex',
+    'stex': 'tex',
+    'wolf': 'wolfram',
+    'translate': 'translate',
+    'Translate': 'translate',
+    'translate_recent': 'translate',
+}
+
+
+class RateLimited(commands.CheckFailure):
+    def __init__(self, retry_after: float, notify: bool):
+        self.retry_after = retry_after
+        # Only the first refusal in a row is worth telling the user about.
+        self.notify = notify
+        super().__init__(f'Rate limited. Try again in {math.ceil(retry_after)}s.')
+
+
+class TokenBucket:
+    __slots__ = ('limit', 'tokens', 'updated', 'warned')
+
+    def __init__(self, limit: RateLimit, now: float):
+        self.limit = limit
+        self.tokens = float(limit.capacity)
+        self.updated = now
+        self.warned = False
+
+    def refill(self, now: float):
+        rate = self.limit.capacity / self.limit.per
+        self.tokens = min(self.limit.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.limit.per / self.limit.capacity
+
+    def idle(self, now: float) -> bool:
+        """A bucket that would have refilled by now behaves exactly like a new one."""
+        return self.tokens + (now - self.updated) * self.limit.capacity / self.limit.per >= self.limit.capacity
+
+
+class RateLimiter:
+    """Token buckets keyed by command class, scope (user or guild) and id.
+
+    A call is allowed only if every bucket it counts against has a token, and
+    only then are tokens taken. Buckets are kept in LRU order; on each call idle
+    ones are dropped from the cold end, as are the oldest once there are
+    ``max_buckets`` of them.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, RateLimit]]] = None, max_buckets: int = 10000):
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.max_buckets = max_buckets
+        self._buckets: 'OrderedDict[Hashable, TokenBucket]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _bucket(self, key: Hashable, limit: RateLimit, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+        bucket = self._buckets[key] = TokenBucket(limit, now)
+        return bucket
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) < self.max_buckets and not bucket.idle(now):
+                return
+            del self._buckets[key]
+
+    def hit(self, command_class: str, user_id: int, guild_id: Optional[int] = None):
+        """Take a token for a call, or raise ``RateLimited``."""
+        limits = self.limits.get(command_class)
+        if not limits:
+            return
+        now = time.monotonic()
+        self._evict(now)
+        ids = {'user': user_id, 'guild': guild_id}
+        buckets = []
+        for scope, limit in limits.items():
+            if ids.get(scope) is None:
+                continue
+            bucket = self._bucket((command_class, scope, ids[scope]), limit, now)
+            bucket.refill(now)
+            buckets.append(bucket)
+        retry_after = max((bucket.retry_after() for bucket in buckets), default=0.0)
+        if retry_after:
+            notify = not any(bucket.warned for bucket in buckets)
+            for bucket in buckets:
+                bucket.warned = True
+            raise RateLimited(retry_after, notify)
+        for bucket in buckets:
+            bucket.tokens -= 1
+            bucket.warned = False
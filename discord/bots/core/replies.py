@@ -0,0 +1,93 @@
+import asyncio
+import functools
+from typing import Dict, Hashable, NamedTuple, Optional
+
+import discord
+from discord.ext import commands
+
+from .cache import LRUCache
+
+
+class TrackedReply(NamedTuple):
+    message: discord.Message
+    # Normalized command input the reply was produced from.
+    key: Hashable
+
+
+class ReplyRegistry:
+    """The bot's reply to each recent command message, shared by all cogs.
+
+    When a command message is edited the command runs again; cogs then edit
+    their earlier reply in place, or skip the work entirely when the
+    normalized input is unchanged. Entries expire after ``ttl`` seconds and
+    at most ``size_limit`` are kept, least recently used first out.
+
+    Only the newest run for a message may write to its reply: a run that is
+    still going when the message is edited again, or deleted, is cancelled.
+    """
+
+    def __init__(self, size_limit: int = 1000, ttl: float = 60 * 60):
+        self.ttl = ttl
+        self._replies = LRUCache(size_limit, sizeof=lambda _: 1)
+        # The task running the command for each message, while it runs.
+        self._running: Dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._replies)
+
+    def get(self, message_id: int) -> Optional[TrackedReply]:
+        return self._replies.get(message_id)
+
+    def pop(self, message_id: int) -> Optional[TrackedReply]:
+        return self._replies.pop(message_id)
+
+    def track(self, message_id: int, reply: discord.Message, key: Hashable):
+        self._replies.set(message_id, TrackedReply(reply, key), ttl=self.ttl)
+
+    def unchanged(self, message_id: int, key: Hashable) -> bool:
+        """Whether ``message_id`` already has a reply for this exact input."""
+        tracked = self.get(message_id)
+        return tracked is not None and tracked.key == key
+
+    def supersede(self, message_id: int):
+        """Make the current task the run for ``message_id``, cancelling the one it replaces."""
+        task = asyncio.current_task()
+        previous = self._running.get(message_id)
+        if previous is task:
+            return
+        if previous is not None:
+            previous.cancel()
+        self._running[message_id] = task
+        task.add_done_callback(functools.partial(self._finished, message_id))
+
+    def _finished(self, message_id: int, task: asyncio.Task):
+        if self._running.get(message_id) is task:
+            del self._running[message_id]
+
+    async def send(self, ctx: commands.Context, key: Hashable, **kwargs) -> discord.Message:
+        """Edit the reply tracked for ``ctx.message`` into ``kwargs``, or reply anew, and track it.
+
+        ``kwargs`` are those of ``ctx.reply``; attachments of the old reply are dropped.
+        """
+        tracked = self.get(ctx.message.id)
+        message = None
+        if tracked is not None:
+            try:
+                message = await tracked.message.edit(attachments=[], **kwargs)
+            except discord.NotFound:
+                pass
+        if message is None:
+            message = await ctx.reply(**kwargs)
+        self.track(ctx.message.id, message, key)
+        return message
+
+    async def delete(self, message_id: int):
+        running = self._running.pop(message_id, None)
+        if running is not None and running is not asyncio.current_task():
+            running.cancel()
+        tracked = self.pop(message_id)
+        if tracked is not None:
+            try:
+                await tracked.message.delete()
+            except discord.NotFound:
+                pass
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import discord
+
+from .metrics import backend_request_seconds, label_set, registry
+
+T = TypeVar('T')
+Owner = Tuple[Optional[int], int]
+
+
+class Busy(Exception):
+    """The backend's queue is full; the caller should be told to retry later."""
+
+    def __init__(self, name: str):
+        self.name = name
+        super().__init__(f'{name} is busy')
+
+
+def owner_of(user: discord.abc.User) -> Owner:
+    """``(guild id, user id)`` of a caller, with no guild outside of one."""
+    guild = getattr(user, 'guild', None)
+    return (guild.id if guild else None, user.id)
+
+
+class Scheduler:
+    """Bounded concurrency for one backend, with a bounded, fair queue in front.
+
+    At most ``concurrency`` jobs run at once. Waiting jobs are handed slots
+    round-robin across guilds, and across users within a guild, so one busy
+    caller only delays their own jobs. When ``max_queued`` jobs are already
+    waiting, new ones fail fast with ``Busy``.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queued: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._guilds: 'OrderedDict[Optional[int], OrderedDict[int, deque]]' = OrderedDict()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'concurrency': self.concurrency,
+            'max_queued': self.max_queued,
+            'waited': self.waited,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+
+    def _enqueue(self, owner: Owner) -> asyncio.Future:
+        guild_id, user_id = owner
+        waiter = asyncio.get_running_loop().create_future()
+        self._guilds.setdefault(guild_id, OrderedDict()).setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        return waiter
+
+    def _dequeue(self, owner: Owner, waiter: asyncio.Future):
+        guild_id, user_id = owner
+        users = self._guilds[guild_id]
+        users[user_id].remove(waiter)
+        if not users[user_id]:
+            del users[user_id]
+            if not users:
+                del self._guilds[guild_id]
+        self.queued -= 1
+
+    def _wake_next(self):
+        while self.queued and self.running < self.concurrency:
+            guild_id, users = next(iter(self._guilds.items()))
+            self._guilds.move_to_end(guild_id)
+            user_id, waiters = next(iter(users.items()))
+            users.move_to_end(user_id)
+            waiter = waiters[0]
+            self._dequeue((guild_id, user_id), waiter)
+            self.running += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self.running -= 1
+        self._wake_next()
+
+    async def _acquire(self, owner: Owner):
+        if self.running < self.concurrency and not self.queued:
+            self.running += 1
+            self._record_wait(0.0)
+            return
+        if self.queued >= self.max_queued:
+            raise Busy(self.name)
+        waiter = self._enqueue(owner)
+        queued_at = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled; pass it on.
+                self._release()
+            else:
+                self._dequeue(owner, waiter)
+            raise
+        self._record_wait(time.monotonic() - queued_at)
+
+    def _record_wait(self, wait: float):
+        self.waited += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner: Owner) -> AsyncIterator[None]:
+        """Hold one of the backend's slots for the duration of the block."""
+        await self._acquire(owner)
+        started = time.perf_counter()
+        # Outcomes go to backend_responses where requests are made: the HTTP
+        # clients' trace config and transport see every status exactly once.
+        try:
+            yield
+        finally:
+            backend_request_seconds.observe(time.perf_counter() - started, backend=self.name)
+            self._release()
+
+    async def run(self, owner: Owner, factory: Callable[[], Awaitable[T]]) -> T:
+        async with self.slot(owner):
+            return await factory()
+
+
+# Backend name -> scheduler, shared by every cog that calls the backend.
+schedulers: Dict[str, Scheduler] = {}
+
+
+def get_scheduler(name: str, concurrency: int = 4, max_queued: int = 32) -> Scheduler:
+    """Return the scheduler for backend ``name``, creating it on first use."""
+    scheduler = schedulers.get(name)
+    if scheduler is None:
+        scheduler = schedulers[name] = Scheduler(name, concurrency, max_queued)
+    return scheduler
+
+
+def _scheduler_stats(key: str) -> Callable[[], Dict]:
+    return lambda: {label_set(backend=name): scheduler.stats()[key] for name, scheduler in schedulers.items()}
+
+
+registry.gauge('backend_running', 'Backend calls in progress.', _scheduler_stats('running'))
+registry.gauge('backend_queued', 'Backend calls waiting for a slot.', _scheduler_stats('queued'))
+registry.counter('backend_wait_seconds_total', 'Total time backend calls spent queued.', _scheduler_stats('wait_total'))
+registry.gauge('backend_wait_max_seconds', 'Longest time a backend call spent queued.', _scheduler_stats('wait_max'))
@@ -0,0 +1,29 @@
+import asyncio
+import os
+
+from bots.core.execution import LocalBackend, RunnerServer
+
+# Comma-separated languages (e.g. "python,c,c++") to serve; every installed one by default.
+CODE_LOCAL_LANGUAGES = [
+    language.strip()
+    for language in os.environ.get("CODE_LOCAL_LANGUAGES", "").split(",")
+    if language.strip()
+]
+RUNNER_HOST = os.environ.get("RUNNER_HOST", "127.0.0.1")
+RUNNER_PORT = int(os.environ.get("RUNNER_PORT", "8080"))
+
+
+async def main():
+    backend = LocalBackend(enabled=CODE_LOCAL_LANGUAGES or None)
+    # Check the sandbox now, so a misconfigured runner says so at startup.
+    print(f"Serving {', '.join(await backend.languages(None)) or 'no languages'}")
+    server = RunnerServer(backend, RUNNER_HOST, RUNNER_PORT)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())